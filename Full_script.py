@@ -15,7 +15,8 @@ from telegram.ext import (
     filters,
     CallbackQueryHandler,
 )
-import threading  # Added for locking
+import secrets
+import argparse
 
 os.environ["DISPLAY"] = ":99"
 
@@ -23,27 +24,63 @@ load_dotenv()
 
 from config import (
     TELEGRAM_BOT_TOKEN,
-    NETSCAPE_COOKIES_FILE,
-    TIKTOK_COOKIES_JSON,
     log,
     init_db,
     DB_CONN,
+    OUTPUT_PATH,
+    DOWNLOAD_CACHE_BYTES,
+    DOWNLOAD_CACHE_POLICY,
     MAX_VIDEOS_PER_REQUEST,
-    MAX_CONCURRENT_DOWNLOADS
-)
-from tiktok import (
-    setup_browser,
-    load_cookies_from_file,
-    apply_cookies,
-    convert_json_to_netscape,
-    collect_batch_urls,
+    MAX_CONCURRENT_DOWNLOADS,
+    MIN_CONCURRENT_DOWNLOADS,
+    INITIAL_CONCURRENT_DOWNLOADS,
+    DOWNLOAD_LATENCY_TARGET,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_BACKOFF_BASE,
+    BREAKER_FAILURES,
+    BREAKER_RESET,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    CONCURRENT_UPDATES,
+    TELEGRAM_API_BASE_URL,
+    SQLITE_FILE,
+    PENDING_TTL,
+    PENDING_MAX,
+    PENDING_PERSIST,
+    METRICS_HOST,
+    METRICS_PORT,
+    WORKER_METRICS_PORT,
+    ADMIN_USER_IDS,
+    PROFILE_DIR,
+    BOT_MODE,
+    JOB_QUEUE_URL,
+    WORKER_BROWSER,
 )
+from tiktok import collect_batch_urls
 
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import downloader
 import bot as bot_module
-download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
+from disk_cache import DiskCache
+from concurrency import AdaptiveLimiter, CircuitBreaker
+from cancel import Cancelled
+from pending import PendingStore
+from jobqueue import open_job_queue
+from worker import start_browser_session, run_worker, RemoteCollector, RemoteDownloader
+from profiler import latest_profiles
+from transcode import transcoder
+import metrics
+download_limiter = AdaptiveLimiter(
+    INITIAL_CONCURRENT_DOWNLOADS,
+    min_limit=MIN_CONCURRENT_DOWNLOADS,
+    max_limit=MAX_CONCURRENT_DOWNLOADS,
+    latency_target=DOWNLOAD_LATENCY_TARGET,
+)
+download_breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET)
+download_cache = DiskCache(OUTPUT_PATH, DOWNLOAD_CACHE_BYTES, DOWNLOAD_CACHE_POLICY)
 
 # --- Start DB and browser ---
 def start_state():
@@ -79,64 +116,120 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 # --- Async downloader wrapper ---
-async def async_downloader(urls):
-    """Download multiple videos concurrently, limited by MAX_CONCURRENT_DOWNLOADS."""
+async def async_downloader(urls, cancel_token=None):
+    """Download multiple videos concurrently under the adaptive download limit."""
     out = []
 
     async def sem_download(url):
-        async with download_semaphore:
-            try:
-                r = await downloader.download_video(url, os.path.join(os.getcwd(), "downloads"))
-                if r:
-                    path, _meta = r
-                    out.append(path)
-            except Exception as e:
-                log(f"[WARNING] downloader failure for {url}: {e}")
+        cached = transcoder.cached(url, OUTPUT_PATH)
+        if cached:
+            download_cache.add(cached)
+            out.append(cached)
+            return
+        try:
+            r = await downloader.download_with_policy(
+                url, OUTPUT_PATH, download_limiter, download_breaker,
+                retries=DOWNLOAD_RETRIES, backoff_base=DOWNLOAD_BACKOFF_BASE,
+                cancel_token=cancel_token,
+            )
+            if r:
+                source, _meta = r
+                # runs in the transcode pool while the other downloads keep going
+                path = await transcoder.fit(source)
+                if path != source and os.path.exists(source):
+                    # TRANSCODE_KEEP_SOURCE: still counts against the byte budget
+                    download_cache.add(source, pin=False)
+                # pinned until the upload releases it
+                download_cache.add(path)
+                out.append(path)
+        except Cancelled:
+            pass
+        except Exception as e:
+            log(f"[WARNING] downloader failure for {url}: {e}")
 
     # create tasks
     tasks = [sem_download(u) for u in urls]
     await asyncio.gather(*tasks)
+    if cancel_token and cancel_token.is_set():
+        # nobody will upload these; unpin so they can be evicted
+        for path in out:
+            download_cache.release(path)
+        cancel_token.raise_if_cancelled()
     return out
 
-async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Build confirmation buttons
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Yes", callback_data="confirm_yes"),
-            InlineKeyboardButton("❌ No", callback_data="confirm_no"),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ Admins only.")
+        return
+    await update.message.reply_text(metrics.stats_text())
 
-    # Ask for confirmation before fetching videos
-    await update.message.reply_text(
-        f"Do you want me to fetch videos for: “{update.message.text}” ?",
-        reply_markup=reply_markup
-    )
+async def cmd_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profiles [n]: list the newest request profiles and send the latest one."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ Admins only.")
+        return
+    n = int(context.args[0]) if context.args and context.args[0].isdigit() else 5
+    files = latest_profiles(n)
+    if not files:
+        await update.message.reply_text(f"No profiles in {PROFILE_DIR}/ (set PROFILE_USERS or PROFILE_SLOW_PERCENT).")
+        return
+    await update.message.reply_text("🔬 Latest profiles:\n" + "\n".join(os.path.basename(p) for p in files))
+    with open(files[0], "rb") as f:
+        await update.message.reply_document(document=f, filename=os.path.basename(files[0]))
 
-    # store pending request details in context so confirmation handler can access it
-    context.user_data["pending_request"] = {
-        "update": update,
-        "message_text": update.message.text,
-    }
-    context.user_data["awaiting_confirmation"] = True
+async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # parse now, ask for confirmation; only the parsed fields are kept until ✅
+    await bot_module.handle_user_request(
+        update, context,
+        context.bot_data["collect_fn"],
+        context.bot_data["downloader_fn"],
+    )
 
-def build_app(token, driver, db_conn):
-    app = Application.builder().token(token).build()
+def build_app(token, driver, db_conn, concurrent_updates=CONCURRENT_UPDATES, base_url=TELEGRAM_API_BASE_URL):
+    builder = Application.builder().token(token)
+    # handlers for different users run in parallel (1 = sequential)
+    builder = builder.concurrent_updates(max(1, concurrent_updates))
+    if base_url:
+        builder = builder.base_url(base_url).base_file_url(base_url.replace("/bot", "/file/bot", 1))
+    app = builder.build()
     # store driver + db_conn for access in handlers
     app.bot_data["tiktok_driver"] = driver
     app.bot_data["db_conn"] = db_conn
+    app.bot_data["disk_cache"] = download_cache
+    app.bot_data["pending_store"] = PendingStore(
+        PENDING_TTL, PENDING_MAX, SQLITE_FILE if PENDING_PERSIST else None
+    )
 
     # ✅ add these so confirmation callback knows what functions to call
     app.bot_data["collect_fn"] = collect_batch_urls
     app.bot_data["downloader_fn"] = async_downloader
 
     app.add_handler(CommandHandler("start", cmd_start))
+    app.add_handler(CommandHandler("stats", cmd_stats))
+    app.add_handler(CommandHandler("profiles", cmd_profiles))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), on_message))
     app.add_handler(CallbackQueryHandler(bot_module.confirmation_callback))
     return app
 
 def main():
+    ap = argparse.ArgumentParser(description="TikTok downloader Telegram bot")
+    ap.add_argument("--mode", choices=("all", "frontend", "worker"), default=BOT_MODE,
+                    help="all: one process; frontend: bot only, jobs go to workers; worker: scrape/download jobs")
+    args = ap.parse_args()
+
+    metrics_port = WORKER_METRICS_PORT if args.mode == "worker" else METRICS_PORT
+    if metrics_port:
+        try:
+            metrics.start_server(metrics_port, METRICS_HOST)
+        except OSError as e:
+            # e.g. a second process on the same box; the bot itself doesn't need it
+            log(f"[WARNING] metrics server not started on {METRICS_HOST}:{metrics_port}: {e}")
+
+    if args.mode == "worker":
+        log("Starting TikTok scraper/download worker...")
+        run_worker(open_job_queue(JOB_QUEUE_URL), with_browser=WORKER_BROWSER)
+        return
+
     if not TELEGRAM_BOT_TOKEN:
         print("TELEGRAM_BOT_TOKEN env required")
         sys.exit(2)
@@ -145,24 +238,41 @@ def main():
     # sqlite
     db_conn = start_state()
 
-    # browser
-    driver = setup_browser()
-    cookies = load_cookies_from_file(TIKTOK_COOKIES_JSON)
-    log("✅ Loading cookies from file...")
-    log(f"✅ Loaded {len(cookies)} cookies")
-    apply_cookies(driver, cookies)
-    convert_json_to_netscape(TIKTOK_COOKIES_JSON, NETSCAPE_COOKIES_FILE)
-
-    # Create a lock for the driver to ensure thread-safe access
-    driver_lock = threading.Lock()
-    # wire bot
-    app = build_app(TELEGRAM_BOT_TOKEN, driver, db_conn)
-    # Store the lock in bot_data for access in handlers
-    app.bot_data["driver_lock"] = driver_lock
+    if args.mode == "frontend":
+        # no browser here: collect/download run on workers via the job queue
+        queue = open_job_queue(JOB_QUEUE_URL)
+        app = build_app(TELEGRAM_BOT_TOKEN, None, db_conn)
+        app.bot_data["collect_fn"] = RemoteCollector(queue)
+        app.bot_data["downloader_fn"] = RemoteDownloader(queue, download_cache)
+        log(f"📮 frontend mode, jobs -> {JOB_QUEUE_URL}")
+    else:
+        # browser
+        driver, driver_lock, cookie_jar = start_browser_session()
+        # wire bot
+        app = build_app(TELEGRAM_BOT_TOKEN, driver, db_conn)
+        # Store the lock in bot_data for access in handlers
+        app.bot_data["driver_lock"] = driver_lock
+        app.bot_data["cookie_jar"] = cookie_jar
     log("🤖 telegram ai started")
 
-    # run polling (blocking)
-    app.run_polling()
+    if WEBHOOK_URL:
+        run_webhook(app)
+    else:
+        # run polling (blocking)
+        app.run_polling()
+
+def run_webhook(app):
+    """Serve updates through PTB's built-in webhook server (blocking)."""
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    url_path = WEBHOOK_PATH.strip("/")
+    log(f"🌐 webhook mode on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{url_path}")
+    app.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=url_path,
+        secret_token=secret,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{url_path}",
+    )
 
 if __name__ == "__main__":
     main()
@@ -174,7 +284,18 @@ if __name__ == "__main__":
 
 from datetime import datetime
 import os
+import sys
+import re
+import json
+import queue
+import random
 import sqlite3
+import atexit
+import logging
+import logging.handlers
+import contextvars
+import uuid
+from contextlib import contextmanager
 from dotenv import load_dotenv
 load_dotenv()
 # ------------------- Env / Tunables -------------------
@@ -187,6 +308,10 @@ NETSCAPE_COOKIES_FILE = os.getenv("NETSCAPE_COOKIES_FILE", "tiktok_cookies.txt")
 OUTPUT_PATH = os.path.join(os.getcwd(), "downloads")
 os.makedirs(OUTPUT_PATH, exist_ok=True)
 
+# size budget for downloads/ (oldest / least-sent files are evicted first)
+DOWNLOAD_CACHE_BYTES = int(os.getenv("DOWNLOAD_CACHE_BYTES", str(2 * 1024 ** 3)))
+DOWNLOAD_CACHE_POLICY = os.getenv("DOWNLOAD_CACHE_POLICY", "lru")   # lru | lfu
+
 PRELOAD_TARGET = int(os.getenv("PRELOAD_TARGET", "10"))
 ROTATION_BATCH_SIZE = max(5, PRELOAD_TARGET)
 VIDEO_CACHE_MAXLEN = int(os.getenv("VIDEO_CACHE_MAXLEN", "128"))
@@ -194,12 +319,198 @@ MAX_VIDEOS_PER_REQUEST = int(os.getenv("MAX_VIDEOS_PER_REQUEST", "10"))
 
 SEARCH_QUERIES_FALLBACK = ["4k", "edit", "fyp", "funny", "movie"]
 
-MAX_CONCURRENT_DOWNLOADS = 10
+# how search results are read: auto (page JSON, DOM fallback) | network (JSON only) | dom
+SEARCH_EXTRACTION_MODE = os.getenv("SEARCH_EXTRACTION_MODE", "auto")
+SEARCH_NETWORK_SCROLLS = int(os.getenv("SEARCH_NETWORK_SCROLLS", "2"))   # scrolls to pull more result pages
+
+# opt-in request profiler (see profiler.py)
+PROFILE_USERS = {int(x) for x in os.getenv("PROFILE_USERS", "").replace(" ", "").split(",") if x}
+PROFILE_SLOW_PERCENT = float(os.getenv("PROFILE_SLOW_PERCENT", "0"))   # e.g. 5 = keep slowest 5%
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.01"))        # seconds between samples
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "20"))
+
+# frontend / worker split (python main.py --mode all|frontend|worker)
+BOT_MODE = os.getenv("BOT_MODE", "all")
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "sqlite:///jobs.db")
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "0.5"))
+JOB_TIMEOUT = float(os.getenv("JOB_TIMEOUT", "600"))             # frontend gives up waiting after this
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "86400"))       # finished jobs kept for a day
+WORKER_DOWNLOAD_SLOTS = int(os.getenv("WORKER_DOWNLOAD_SLOTS", "4"))
+WORKER_BROWSER = os.getenv("WORKER_BROWSER", "1") == "1"         # 0: download-only worker
+# workers don't share METRICS_PORT with the frontend; give each its own port to scrape it (0 = off)
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "0"))
+
+# per-user conversation memory
+AI_MEMORY_RETENTION = int(os.getenv("AI_MEMORY_RETENTION", "200"))        # queries kept per user
+AI_MEMORY_PROMPT_ROWS = int(os.getenv("AI_MEMORY_PROMPT_ROWS", "30"))      # rows read for the prompt
+AI_MEMORY_PROMPT_TOKENS = int(os.getenv("AI_MEMORY_PROMPT_TOKENS", "200")) # prompt budget for history
+AI_MEMORY_VACUUM_PAGES = int(os.getenv("AI_MEMORY_VACUUM_PAGES", "256"))   # free pages before VACUUM
+
+# per-user valuable-word model fed into query expansion
+VALUABLE_WORDS_PROMPT_MAX = int(os.getenv("VALUABLE_WORDS_PROMPT_MAX", "15"))   # words per prompt
+VALUABLE_WORDS_HALF_LIFE = float(os.getenv("VALUABLE_WORDS_HALF_LIFE_DAYS", "14")) * 86400
+VALUABLE_WORDS_MODEL_MAX = int(os.getenv("VALUABLE_WORDS_MODEL_MAX", "500"))    # words kept in memory per user
+
+# requests waiting for ✅/❌
+PENDING_TTL = int(os.getenv("PENDING_TTL", "900"))           # seconds
+PENDING_MAX = int(os.getenv("PENDING_MAX", "5000"))
+PENDING_PERSIST = os.getenv("PENDING_PERSIST", "1") == "1"   # keep them in bot_state.db across restarts
+
+# adaptive download concurrency (AIMD between MIN and MAX)
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "10"))
+MIN_CONCURRENT_DOWNLOADS = int(os.getenv("MIN_CONCURRENT_DOWNLOADS", "1"))
+INITIAL_CONCURRENT_DOWNLOADS = int(os.getenv("INITIAL_CONCURRENT_DOWNLOADS", "4"))
+DOWNLOAD_LATENCY_TARGET = float(os.getenv("DOWNLOAD_LATENCY_TARGET", "60"))   # seconds per video
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", "2"))
+DOWNLOAD_BACKOFF_BASE = float(os.getenv("DOWNLOAD_BACKOFF_BASE", "2"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_RESET = float(os.getenv("BREAKER_RESET", "60"))
+
+# cookie jar shared between Selenium and yt-dlp
+COOKIE_SYNC_INTERVAL = int(os.getenv("COOKIE_SYNC_INTERVAL", "300"))     # seconds
+COOKIE_EXPIRY_MARGIN = int(os.getenv("COOKIE_EXPIRY_MARGIN", "86400"))   # warn a day ahead
+
+# serving mode: polling (default) or webhook when WEBHOOK_URL is set
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")                # public base url, e.g. https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")          # generated at startup if empty
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "16"))
+# point at a local/fake Bot API server, e.g. http://127.0.0.1:8081/bot
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "")
+
+# post-download ffprobe/ffmpeg step (see transcode.py); a local Bot API server allows ~2GB
+TRANSCODE_ENABLED = os.getenv("TRANSCODE_ENABLED", "0") == "1"
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+TRANSCODE_MAX_BYTES = int(os.getenv("TRANSCODE_MAX_BYTES", str((2000 if TELEGRAM_API_BASE_URL else 49) * 1024 ** 2)))
+TRANSCODE_MAX_KBPS = int(os.getenv("TRANSCODE_MAX_KBPS", "4000"))      # total bitrate target, 0 = size only
+TRANSCODE_PRESET = os.getenv("TRANSCODE_PRESET", "veryfast")         # libx264 preset
+TRANSCODE_AUDIO_KBPS = int(os.getenv("TRANSCODE_AUDIO_KBPS", "128"))
+TRANSCODE_MAX_HEIGHT = int(os.getenv("TRANSCODE_MAX_HEIGHT", "1280"))  # downscale taller videos when re-encoding
+TRANSCODE_TIMEOUT = int(os.getenv("TRANSCODE_TIMEOUT", "600"))         # seconds per ffmpeg run
+TRANSCODE_KEEP_SOURCE = os.getenv("TRANSCODE_KEEP_SOURCE", "0") == "1"
+FFMPEG_BIN = os.getenv("FFMPEG_BIN", "ffmpeg")
+FFPROBE_BIN = os.getenv("FFPROBE_BIN", "ffprobe")
+
+# metrics endpoint (0 disables) and admin-only commands
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x}
 
 # ------------------- Logging -------------------
-def log(msg: str):
-    prefix = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-    print(f"{prefix} {msg}")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")             # stdout format: text | json
+LOG_FILE = os.getenv("LOG_FILE", os.path.join("logs", "bot.log"))  # JSON lines; "" disables
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+HOT_LOG_SAMPLE = float(os.getenv("HOT_LOG_SAMPLE", "0.1"))   # fraction of hot-path messages kept
+
+# request_id / user_id / stage of the current task; asyncio tasks get their own copy
+log_context = contextvars.ContextVar("log_context", default={})
+
+_LEVEL_TAG = re.compile(r"^\[[^\]]*\b(ERROR|WARNING)\]")
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        rec = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        rec.update(getattr(record, "ctx", {}))
+        return json.dumps(rec, ensure_ascii=False, default=str)
+
+
+class _TextFormatter(logging.Formatter):
+    def format(self, record):
+        prefix = datetime.fromtimestamp(record.created).strftime("[%Y-%m-%d %H:%M:%S]")
+        ctx = getattr(record, "ctx", {})
+        tags = " ".join(f"{k}={v}" for k, v in ctx.items())
+        return f"{prefix} {record.getMessage()}" + (f" ({tags})" if tags else "")
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never block the caller: drop records when the queue is full."""
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _DroppingQueueHandler.dropped += 1
+
+
+def _setup_logging():
+    logger = logging.getLogger("tiktokbot")
+    logger.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+    logger.propagate = False
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+    handlers = [stream]
+    if LOG_FILE:
+        os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+        rotating = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+        )
+        rotating.setFormatter(_JsonFormatter())
+        handlers.append(rotating)
+
+    # handlers run on the listener thread; callers only enqueue
+    q = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    logger.addHandler(_DroppingQueueHandler(q))
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
+
+
+_logger = _setup_logging()
+
+
+def log(msg: str, level=None, sample=None, **fields):
+    """
+    Queue a log record. Compatible with the old print-based log(msg):
+    "[ERROR] ..." / "[WARNING] ..." prefixes set the level when none is given.
+    `sample` keeps only that fraction of calls (for hot paths); extra keyword
+    fields are added to the structured record.
+    """
+    if sample is not None and random.random() >= sample:
+        return
+    if level is None:
+        m = _LEVEL_TAG.match(msg)
+        level = m.group(1) if m else "INFO"
+    lvl = logging.getLevelName(level.upper()) if isinstance(level, str) else level
+    if not _logger.isEnabledFor(lvl):
+        return
+    ctx = log_context.get()
+    if fields:
+        ctx = {**ctx, **fields}
+    _logger.log(lvl, msg, extra={"ctx": ctx})
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:8]
+
+
+def set_log_context(**fields):
+    """Add fields to the current task's log context (returns a reset token)."""
+    return log_context.set({**log_context.get(), **fields})
+
+
+@contextmanager
+def log_fields(**fields):
+    token = set_log_context(**fields)
+    try:
+        yield
+    finally:
+        log_context.reset(token)
 
 # ------------------- SQLite helpers -------------------
 SQLITE_FILE = os.path.join(os.getcwd(), "bot_state.db")
@@ -264,8 +575,16 @@ from config import (
     NETSCAPE_COOKIES_FILE,
     ROTATION_BATCH_SIZE,
     SEARCH_QUERIES_FALLBACK,
+    SEARCH_EXTRACTION_MODE,
+    SEARCH_NETWORK_SCROLLS,
+    HOT_LOG_SAMPLE,
     log,
 )
+import metrics
+
+ACTIVE_DRIVERS = metrics.gauge("active_drivers", "Running Selenium drivers")
+DRIVER_BUSY = metrics.gauge("driver_busy", "Drivers currently scraping")
+SEARCH_SOURCE = metrics.counter("search_results_total", "Search result links by extraction source")
 
 # ---------------- Browser setup ----------------
 def setup_browser():
@@ -294,6 +613,7 @@ def setup_browser():
 
     try:
         driver = webdriver.Firefox(service=Service("/usr/bin/geckodriver"), options=firefox_options)
+        ACTIVE_DRIVERS.inc()
         return driver
     except WebDriverException as e:
         log(f"[ERROR] Failed to start Firefox WebDriver: {e}")
@@ -373,24 +693,160 @@ def _normalize_href(href):
         return href
     return None
 
-def get_fresh_video_links_for_query(driver, query, desired_count=10, scroll_cycles=0, retries=2):
+# ---------------- Search results from page JSON ----------------
+# The search page ships its first results as embedded JSON state and loads
+# further pages from /api/search/ XHRs. Reading those gives ids plus
+# metadata (author, views, duration) without waiting for the grid to render.
+STATE_SCRIPT_IDS = ["__UNIVERSAL_DATA_FOR_REHYDRATION__", "SIGI_STATE", "__NEXT_DATA__"]
+
+READ_STATE_JS = """
+for (const id of arguments[0]) {
+    const el = document.getElementById(id);
+    if (el && el.textContent) return el.textContent;
+}
+return null;
+"""
+
+INSTALL_CAPTURE_JS = """
+if (window.__ttCapture) return;
+window.__ttCapture = [];
+const keep = (url, text) => {
+    if (/\\/api\\/(search|recommend)\\//.test(url)) {
+        try { window.__ttCapture.push(JSON.parse(text)); } catch (e) {}
+    }
+};
+const origFetch = window.fetch;
+window.fetch = function(...args) {
+    return origFetch.apply(this, args).then(resp => {
+        try { const url = resp.url || String(args[0]); resp.clone().text().then(t => keep(url, t)); } catch (e) {}
+        return resp;
+    });
+};
+const origOpen = XMLHttpRequest.prototype.open;
+XMLHttpRequest.prototype.open = function(method, url) {
+    this.addEventListener("load", () => { try { keep(String(url), this.responseText); } catch (e) {} });
+    return origOpen.apply(this, arguments);
+};
+"""
+
+DRAIN_CAPTURE_JS = "const c = window.__ttCapture || []; window.__ttCapture = []; return JSON.stringify(c);"
+
+# the state script is in the HTML, so it's normally there as soon as driver.get returns
+STATE_WAIT = 1.5      # seconds to keep polling for it before giving up
+STATE_POLL = 0.1
+
+def _looks_like_item(d):
+    vid = d.get("id")
+    return (
+        isinstance(vid, str) and vid.isdigit()
+        and isinstance(d.get("author"), (dict, str))
+        and ("video" in d or "stats" in d)
+    )
+
+def _iter_items(node, depth=0):
+    # payload layouts differ between state blobs and API versions; find items by shape
+    if depth > 12:
+        return
+    if isinstance(node, dict):
+        if _looks_like_item(node):
+            yield node
+            return
+        for v in node.values():
+            yield from _iter_items(v, depth + 1)
+    elif isinstance(node, list):
+        for v in node:
+            yield from _iter_items(v, depth + 1)
+
+def parse_search_payload(payload):
+    """Search JSON (embedded state or API response) -> list of result dicts."""
+    results = {}
+    for item in _iter_items(payload):
+        author = item["author"]
+        author = author.get("uniqueId", "") if isinstance(author, dict) else author
+        if not author:
+            continue
+        stats = item.get("stats") or {}
+        video = item.get("video") or {}
+        results[item["id"]] = {
+            "id": item["id"],
+            "url": f"https://www.tiktok.com/@{author}/video/{item['id']}",
+            "author": author,
+            "views": int(stats.get("playCount") or 0),
+            "likes": int(stats.get("diggCount") or 0),
+            "duration": video.get("duration"),
+            "desc": item.get("desc", ""),
+            "create_time": item.get("createTime"),
+        }
+    return list(results.values())
+
+def rank_search_results(results):
+    """Most viewed first."""
+    return sorted(results, key=lambda r: r["views"], reverse=True)
+
+def get_search_results_from_page(driver, desired_count=10, should_stop=None, scrolls=SEARCH_NETWORK_SCROLLS):
+    """
+    Results for the search page already loaded in `driver`: embedded state
+    first, then captured /api/search/ responses while scrolling.
+    """
+    should_stop = should_stop or (lambda: False)
+    found = {}
+    try:
+        deadline = time.monotonic() + STATE_WAIT
+        raw = driver.execute_script(READ_STATE_JS, STATE_SCRIPT_IDS)
+        while not raw and time.monotonic() < deadline and not should_stop():
+            time.sleep(STATE_POLL)
+            raw = driver.execute_script(READ_STATE_JS, STATE_SCRIPT_IDS)
+        if raw:
+            for r in parse_search_payload(json.loads(raw)):
+                found[r["id"]] = r
+        if len(found) < desired_count and scrolls:
+            driver.execute_script(INSTALL_CAPTURE_JS)
+            for _ in range(scrolls):
+                if should_stop() or len(found) >= desired_count:
+                    break
+                driver.execute_script(f"window.scrollBy(0, {random.randint(1200, 2000)})")
+                time.sleep(random.uniform(0.6, 0.9))
+                captured = json.loads(driver.execute_script(DRAIN_CAPTURE_JS) or "[]")
+                for payload in captured:
+                    for r in parse_search_payload(payload):
+                        found.setdefault(r["id"], r)
+    except (WebDriverException, ValueError) as e:
+        log(f"[WARNING] search JSON extraction failed: {e}")
+    return rank_search_results(found.values())
+
+def get_fresh_video_links_for_query(driver, query, desired_count=10, scroll_cycles=0, retries=2, should_stop=None,
+                                    mode=SEARCH_EXTRACTION_MODE):
     """
     Navigate to a search URL for `query`, scroll, collect candidate video links.
-    Returns up to desired_count unique links.
+    Returns up to desired_count unique links; stops early once should_stop() is true.
+    mode "auto" reads the page's result JSON and only falls back to the DOM
+    when that comes up short; "network" and "dom" use one source only.
     """
+    should_stop = should_stop or (lambda: False)
     query_str = str(query or "")
     encoded = urllib.parse.quote(query_str.replace(",", " "))
     search_url = f"https://www.tiktok.com/search?q={encoded}"
     driver.get(search_url)
-    time.sleep(2 + random.uniform(0.5, 1.0))
-    log(f"🔄 Rotating search page: {query_str}")
+    log(f"🔄 Rotating search page: {query_str}", sample=HOT_LOG_SAMPLE)
 
-    collected = set()
+    collected = []
+    if mode in ("auto", "network"):
+        collected = [r["url"] for r in get_search_results_from_page(driver, desired_count, should_stop)]
+        SEARCH_SOURCE.inc(len(collected), source="json")
+        if len(collected) >= desired_count or mode == "network":
+            return collected[:desired_count]
+
+    # DOM fallback: only now wait for the result grid to render
+    time.sleep(2 + random.uniform(0.5, 1.0))
+    ranked = collected
+    collected = set(collected)
     attempt = 0
-    while len(collected) < desired_count and attempt < retries:
+    while len(collected) < desired_count and attempt < retries and not should_stop():
         attempt += 1
         # scroll a few times
         for _ in range(scroll_cycles):
+            if should_stop():
+                break
             driver.execute_script(f"window.scrollBy(0, {random.randint(800,1600)})")
             time.sleep(random.uniform(0.8, 1.0))
         try:
@@ -423,23 +879,33 @@ def get_fresh_video_links_for_query(driver, query, desired_count=10, scroll_cycl
             if len(collected) >= desired_count:
                 break
 
-    return list(collected)[:desired_count]
+    # JSON results keep their ranking, DOM-only finds go after them
+    extra = [u for u in collected if u not in set(ranked)]
+    SEARCH_SOURCE.inc(len(extra), source="dom")
+    return (ranked + extra)[:desired_count]
 
 def rotator_pick_queries():
     # use env config SEARCH_QUERIES if provided in main; fallback otherwise
     from config import SEARCH_QUERIES_FALLBACK
     return SEARCH_QUERIES_FALLBACK[:]
 
-def collect_batch_urls(driver, query_list, per_query=10, batch_limit=50):
+@metrics.timed("collect")
+def collect_batch_urls(driver, query_list, per_query=10, batch_limit=50, should_stop=None):
     urls = []
-    for q in query_list:
-        found = get_fresh_video_links_for_query(driver, q, desired_count=per_query)
-        for u in found:
-            if u not in urls:
-                urls.append(u)
-            if len(urls) >= batch_limit:
-                return urls
-    return urls
+    DRIVER_BUSY.inc()
+    try:
+        for q in query_list:
+            if should_stop and should_stop():
+                break
+            found = get_fresh_video_links_for_query(driver, q, desired_count=per_query, should_stop=should_stop)
+            for u in found:
+                if u not in urls:
+                    urls.append(u)
+                if len(urls) >= batch_limit:
+                    return urls
+        return urls
+    finally:
+        DRIVER_BUSY.dec()
 
 
 •== END tiktok.py ==•
@@ -450,8 +916,13 @@ def collect_batch_urls(driver, query_list, per_query=10, batch_limit=50):
 import os
 import re
 import json
+import time
+import heapq
 import sqlite3
 import asyncio
+import threading
+import contextvars
+from collections import Counter
 from datetime import datetime
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -459,9 +930,26 @@ from telegram.ext import ContextTypes, ConversationHandler, MessageHandler, filt
 
 from config import (
     MAX_VIDEOS_PER_REQUEST,
+    AI_MEMORY_RETENTION,
+    AI_MEMORY_PROMPT_ROWS,
+    AI_MEMORY_PROMPT_TOKENS,
+    AI_MEMORY_VACUUM_PAGES,
+    VALUABLE_WORDS_PROMPT_MAX,
+    VALUABLE_WORDS_HALF_LIFE,
+    VALUABLE_WORDS_MODEL_MAX,
     log,
+    new_request_id,
+    set_log_context,
     OPENAI_API_KEY,
 )
+import metrics
+from cancel import Cancelled, CancelToken
+from profiler import profiler
+
+REQUESTS = metrics.counter("requests_total", "User requests by outcome")
+SENT_CACHE_HITS = metrics.counter("sent_cache_hits_total", "Candidate URLs skipped because already sent")
+VIDEOS_SENT = metrics.counter("videos_sent_total", "Videos uploaded to Telegram")
+UPLOAD_FAILURES = metrics.counter("upload_failures_total", "Failed send_video calls")
 
 # --- OpenAI setup ---
 OPENAI_AVAILABLE = bool(OPENAI_API_KEY)
@@ -489,6 +977,7 @@ def get_user_db_conn(user_id):
 
 def init_user_db_conn(conn):
     cur = conn.cursor()
+    # legacy memory table (one JSON blob of urls per row); migrated into ai_queries below
     cur.execute("""CREATE TABLE IF NOT EXISTS ai_memory (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id TEXT,
@@ -496,11 +985,33 @@ def init_user_db_conn(conn):
         result_urls TEXT,
         ts TEXT
     )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS ai_queries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT,
+        query_text TEXT,
+        ts TEXT
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS ai_query_videos (
+        query_id INTEGER,
+        position INTEGER,
+        video_id TEXT,
+        url TEXT,
+        PRIMARY KEY (query_id, position)
+    )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_ai_queries_user ON ai_queries (user_id, id)")
+    # legacy raw word log; aggregated into word_stats below
     cur.execute("""CREATE TABLE IF NOT EXISTS valuable_words (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id TEXT,
         word TEXT
     )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS word_stats (
+        user_id TEXT,
+        word TEXT,
+        count INTEGER,
+        last_seen REAL,
+        PRIMARY KEY (user_id, word)
+    )""")
     cur.execute("""CREATE TABLE IF NOT EXISTS sent_videos (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         video_id TEXT,
@@ -508,24 +1019,70 @@ def init_user_db_conn(conn):
         sent_at TEXT
     )""")
     conn.commit()
+    _migrate_ai_memory(conn)
+    _migrate_valuable_words(conn)
+
+def _migrate_ai_memory(conn):
+    """Move legacy ai_memory rows into ai_queries / ai_query_videos once."""
+    cur = conn.cursor()
+    if not cur.execute("SELECT 1 FROM ai_memory LIMIT 1").fetchone():
+        return
+    rows = cur.execute("SELECT user_id, query_text, result_urls, ts FROM ai_memory ORDER BY id").fetchall()
+    with conn:
+        for user_id, q, urls, ts in rows:
+            try:
+                urls_list = json.loads(urls) or []
+            except Exception:
+                urls_list = []
+            _insert_memory(cur, user_id, q, urls_list, ts)
+        cur.execute("DELETE FROM ai_memory")
+    log(f"🧠 Migrated {len(rows)} ai_memory rows")
+
+def _migrate_valuable_words(conn):
+    """Fold the legacy one-row-per-occurrence valuable_words table into word_stats."""
+    cur = conn.cursor()
+    if not cur.execute("SELECT 1 FROM valuable_words LIMIT 1").fetchone():
+        return
+    with conn:
+        cur.execute(f"""
+            INSERT INTO word_stats (user_id, word, count, last_seen)
+            SELECT CAST(user_id AS TEXT), lower(word), COUNT(*), ?
+            FROM valuable_words WHERE word IS NOT NULL GROUP BY CAST(user_id AS TEXT), lower(word)
+            {_WORD_UPSERT_TAIL}
+        """, (time.time(),))
+        cur.execute("DELETE FROM valuable_words")
+    log("🧠 Migrated valuable_words into word_stats")
 
 def save_valuable_words_threadsafe(user_id, words):
     conn = get_user_db_conn(user_id)
     save_valuable_words(conn, user_id, words)
     conn.close()
 
-async def load_valuable_words_threadsafe(user_id):
+async def load_valuable_words_threadsafe(user_id, k=VALUABLE_WORDS_PROMPT_MAX):
+    if str(user_id) in _word_models:
+        # served from the in-memory model, no DB round trip
+        return await load_valuable_words(None, user_id, k)
     conn = get_user_db_conn(user_id)
-    words = await load_valuable_words(conn, user_id)
+    words = await load_valuable_words(conn, user_id, k)
     conn.close()
     return words
 
-async def load_ai_memory_threadsafe(user_id, limit=50):
+async def load_ai_memory_threadsafe(user_id, limit=AI_MEMORY_PROMPT_ROWS, with_urls=False):
     conn = get_user_db_conn(user_id)
-    mem = await load_ai_memory(conn, user_id, limit)
+    mem = await load_ai_memory(conn, user_id, limit, with_urls)
     conn.close()
     return mem
 
+# most recent memory entry per user; follow-ups only ever need this one
+_last_memory = {}
+
+async def load_last_memory_threadsafe(user_id):
+    key = str(user_id)
+    if key not in _last_memory:
+        mem = await load_ai_memory_threadsafe(user_id, limit=1, with_urls=True)
+        _last_memory[key] = mem[0] if mem else None
+    return _last_memory[key]
+
 def mark_urls_sent_threadsafe(user_id, urls, video_ids=None):
     conn = get_user_db_conn(user_id)
     mark_urls_sent(conn, urls, video_ids)
@@ -551,51 +1108,154 @@ def mark_urls_sent(conn: sqlite3.Connection, urls, video_ids=None):
             pass
     conn.commit()
 
+def _insert_memory(cur, user_id, query_text, result_urls, ts):
+    cur.execute(
+        "INSERT INTO ai_queries (user_id, query_text, ts) VALUES (?, ?, ?)",
+        (str(user_id), query_text, ts)
+    )
+    qid = cur.lastrowid
+    cur.executemany(
+        "INSERT INTO ai_query_videos (query_id, position, video_id, url) VALUES (?, ?, ?, ?)",
+        [(qid, i, url.rstrip("/").split("/")[-1], url) for i, url in enumerate(result_urls)]
+    )
+
 def save_ai_memory(conn: sqlite3.Connection, user_id, query_text, result_urls):
     cur = conn.cursor()
     ts = datetime.utcnow().isoformat()
+    with conn:
+        _insert_memory(cur, user_id, query_text, result_urls, ts)
+        prune_ai_memory(cur, user_id)
+    _last_memory[str(user_id)] = {"query": query_text, "urls": list(result_urls), "ts": ts}
+    compact_ai_memory(conn)
+
+def prune_ai_memory(cur, user_id, keep=AI_MEMORY_RETENTION):
+    """Drop all but the newest `keep` queries for the user (and their videos)."""
     cur.execute(
-        "INSERT INTO ai_memory (user_id, query_text, result_urls, ts) VALUES (?, ?, ?, ?)",
-        (str(user_id), query_text, json.dumps(result_urls), ts)
+        "SELECT id FROM ai_queries WHERE user_id=? ORDER BY id DESC LIMIT 1 OFFSET ?",
+        (str(user_id), keep)
     )
-    conn.commit()
-
-async def load_ai_memory(conn: sqlite3.Connection, user_id, limit=50):
-    cur = conn.cursor()
+    row = cur.fetchone()
+    if not row:
+        return 0
     cur.execute(
-        "SELECT query_text, result_urls, ts FROM ai_memory WHERE user_id=? ORDER BY id DESC LIMIT ?",
-        (str(user_id), limit)
+        "DELETE FROM ai_query_videos WHERE query_id IN (SELECT id FROM ai_queries WHERE user_id=? AND id<=?)",
+        (str(user_id), row[0])
     )
-    rows = cur.fetchall()
-    mem = []
-    for q, urls, ts in rows:
-        try:
-            urls_list = json.loads(urls)
-        except Exception:
-            urls_list = []
-        mem.append({"query": q, "urls": urls_list, "ts": ts})
-    return mem
+    cur.execute("DELETE FROM ai_queries WHERE user_id=? AND id<=?", (str(user_id), row[0]))
+    return cur.rowcount
 
-def save_valuable_words(conn, user_id, words):
-    cur = conn.cursor()
-    for w in words:
-        try:
-            cur.execute(
-                "INSERT OR IGNORE INTO valuable_words (user_id, word) VALUES (?, ?)",
-                (user_id, w)
-            )
-        except Exception:
-            pass
-    conn.commit()
+def compact_ai_memory(conn: sqlite3.Connection, min_free_pages=AI_MEMORY_VACUUM_PAGES):
+    """VACUUM once pruning has left enough free pages to be worth it."""
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    if free >= min_free_pages:
+        conn.execute("VACUUM")
 
-async def load_valuable_words(conn, user_id):
+async def load_ai_memory(conn: sqlite3.Connection, user_id, limit=AI_MEMORY_PROMPT_ROWS, with_urls=True):
     cur = conn.cursor()
     cur.execute(
-        "SELECT word FROM valuable_words WHERE user_id=?",
-        (user_id,)
+        "SELECT id, query_text, ts FROM ai_queries WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (str(user_id), limit)
     )
     rows = cur.fetchall()
-    return [r[0] for r in rows]
+    urls_by_query = {}
+    if with_urls and rows:
+        ids = [r[0] for r in rows]
+        cur.execute(
+            f"SELECT query_id, url FROM ai_query_videos WHERE query_id IN ({','.join('?' * len(ids))}) "
+            "ORDER BY query_id, position",
+            ids
+        )
+        for qid, url in cur.fetchall():
+            urls_by_query.setdefault(qid, []).append(url)
+    return [{"query": q, "urls": urls_by_query.get(qid, []), "ts": ts} for qid, q, ts in rows]
+
+def summarize_memory(memory, max_tokens=AI_MEMORY_PROMPT_TOKENS):
+    """
+    Recent distinct queries (newest first) as prompt text, cut at roughly
+    `max_tokens` (~4 chars per token). Repeats are folded into a count.
+    """
+    counts = {}
+    order = []
+    for m in memory or []:
+        q = (m.get("query") or "").strip()
+        key = q.lower()
+        if not q:
+            continue
+        if key not in counts:
+            order.append((key, q, (m.get("ts") or "")[:10]))
+        counts[key] = counts.get(key, 0) + 1
+    lines, used = [], 0
+    for key, q, day in order:
+        line = f"{day}: {q}" + (f" (x{counts[key]})" if counts[key] > 1 else "")
+        cost = len(line) // 4 + 1
+        if used + cost > max_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return "\n".join(lines)
+
+# ---------------- Valuable-word model ----------------
+_WORD_UPSERT_TAIL = """
+    ON CONFLICT (user_id, word) DO UPDATE SET
+        count = count + excluded.count,
+        last_seen = MAX(last_seen, excluded.last_seen)
+"""
+
+# user_id -> {word: [count, last_seen]}; the user's strongest words, loaded on first use
+_word_models = {}
+_word_models_lock = threading.Lock()
+
+def _word_score(count, last_seen, now):
+    # counts halve every VALUABLE_WORDS_HALF_LIFE seconds without use
+    return count * 0.5 ** (max(0.0, now - last_seen) / VALUABLE_WORDS_HALF_LIFE)
+
+def _trim_word_model(model, now, keep=VALUABLE_WORDS_MODEL_MAX):
+    if len(model) <= keep:
+        return model
+    best = heapq.nlargest(keep, model.items(), key=lambda kv: _word_score(kv[1][0], kv[1][1], now))
+    return dict(best)
+
+def _load_word_model(conn, user_id):
+    rows = conn.execute(
+        "SELECT word, count, last_seen FROM word_stats WHERE user_id=? ORDER BY count DESC, last_seen DESC LIMIT ?",
+        (str(user_id), VALUABLE_WORDS_MODEL_MAX * 2)
+    ).fetchall()
+    model = {w: [c, ts] for w, c, ts in rows}
+    return _trim_word_model(model, time.time())
+
+def save_valuable_words(conn, user_id, words):
+    """Aggregate this message's words and upsert them in one batch."""
+    counts = Counter(w.lower() for w in words if w)
+    if not counts:
+        return
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT INTO word_stats (user_id, word, count, last_seen) VALUES (?, ?, ?, ?)" + _WORD_UPSERT_TAIL,
+            [(str(user_id), w, n, now) for w, n in counts.items()]
+        )
+    with _word_models_lock:
+        model = _word_models.get(str(user_id))
+        if model is not None:
+            for w, n in counts.items():
+                entry = model.setdefault(w, [0, now])
+                entry[0] += n
+                entry[1] = now
+            _word_models[str(user_id)] = _trim_word_model(model, now)
+
+async def load_valuable_words(conn, user_id, k=VALUABLE_WORDS_PROMPT_MAX):
+    """Top-k words for the user by recency-decayed count."""
+    key = str(user_id)
+    with _word_models_lock:
+        model = _word_models.get(key)
+    if model is None:
+        model = _load_word_model(conn, user_id)
+        with _word_models_lock:
+            model = _word_models.setdefault(key, model)
+    now = time.time()
+    with _word_models_lock:
+        top = heapq.nlargest(k, model.items(), key=lambda kv: _word_score(kv[1][0], kv[1][1], now))
+    return [w for w, _ in top]
 
 # ---------------- GPT query expansion ----------------
 async def expand_query_with_gpt(query: str, valuable_words=None, max_prompts=3):
@@ -604,7 +1264,7 @@ async def expand_query_with_gpt(query: str, valuable_words=None, max_prompts=3):
 
     valuable_text = ""
     if valuable_words:
-        valuable_text = "Previously valuable words: " + ", ".join(valuable_words)
+        valuable_text = "Previously valuable words: " + ", ".join(valuable_words[:VALUABLE_WORDS_PROMPT_MAX])
 
     prompt = f"""
 You are a helpful assistant generating high-quality search prompts for TikTok videos.
@@ -638,6 +1298,7 @@ Return as a JSON array of strings.
     return [query]
 
 # ---------------- Parse user input ----------------
+@metrics.timed("parse")
 async def parse_user_request(text: str, memory=None, last_sent_urls=None, user_id=None):
     text = (text or "").strip()
     if not text:
@@ -653,8 +1314,9 @@ async def parse_user_request(text: str, memory=None, last_sent_urls=None, user_i
 
     if OPENAI_AVAILABLE:
         mem_text = ""
-        if memory:
-            mem_text = "\nUser history:\n" + "\n".join([f"{m['ts']}: {m['query']}" for m in memory])
+        summary = summarize_memory(memory)
+        if summary:
+            mem_text = "\nUser history:\n" + summary
         prompt = f"""
 You are a smart assistant helping fetch TikTok videos.
 User instruction: '''{text}'''
@@ -734,6 +1396,7 @@ def make_markup():
     return InlineKeyboardMarkup([[InlineKeyboardButton("Next ▶️", callback_data="next")]])
 
 # ---------------- AI Fresh URL filter ----------------
+@metrics.timed("filter")
 async def ai_filter_fresh_urls(user_id, candidate_urls, desired_count):
     conn = get_user_db_conn(user_id)
     cur = conn.cursor()
@@ -743,6 +1406,8 @@ async def ai_filter_fresh_urls(user_id, candidate_urls, desired_count):
         cur.execute("SELECT 1 FROM sent_videos WHERE video_id = ?", (vid,))
         if not cur.fetchone():
             fresh.append(url)
+        else:
+            SENT_CACHE_HITS.inc()
         if len(fresh) >= desired_count:
             break
     conn.close()
@@ -770,104 +1435,236 @@ Return at most {desired_count} URLs in JSON array format.
         except Exception as e:
             log(f"[AI FILTER ERROR] {e}")
     return fresh[:desired_count]
-# ---------------- High-level handler ----------------
-CONFIRMATION = range(1)
+# ---------------- Request pipeline ----------------
+class RequestPipeline:
+    """
+    collect -> filter -> download -> mark -> upload for one request.
+    The cancel token is checked between stages, while waiting for the driver,
+    between search queries and inside yt-dlp's progress hook. Starting a new
+    pipeline for a user supersedes (cancels) the one already running.
+    """
 
-# ---- MODIFIED handle_user_request: added db_conn keyword ----
-async def handle_user_request(update: Update, context: ContextTypes.DEFAULT_TYPE, tiktok_collect_fn, downloader_fn, *, db_conn=None):
-    user_text = update.message.text or ""
-    user = update.effective_user
-    user_id = user.id
-    await update.message.chat.send_action("typing")
-    log(f"🤖 user asked: {user_text}")
+    def __init__(self, context, chat_id, user_id, user_text, query, count,
+                 collect_fn, downloader_fn, candidate_urls=None):
+        self.context = context
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.user_text = user_text
+        self.query = query
+        self.count = count
+        self.collect_fn = collect_fn
+        self.downloader_fn = downloader_fn
+        self.candidate_urls = candidate_urls
+        self.id = new_request_id()
+        self.token = CancelToken()
+        self.paths = []     # downloaded, not yet uploaded (pinned in the disk cache)
+
+    def cancel(self, reason="cancelled"):
+        self.token.cancel(reason)
+
+    def cancel_markup(self):
+        return InlineKeyboardMarkup([[InlineKeyboardButton("🛑 Cancel", callback_data=f"stop:{self.id}")]])
+
+    async def say(self, text, **kwargs):
+        return await self.context.bot.send_message(chat_id=self.chat_id, text=text, **kwargs)
+
+    async def run(self):
+        active = self.context.bot_data.setdefault("active_pipelines", {})
+        previous = active.get(self.user_id)
+        if previous:
+            previous.cancel("superseded")
+        active[self.user_id] = self
+        set_log_context(request_id=self.id, user_id=self.user_id)
+        profile = profiler.start(self.id, self.user_id)
+        try:
+            await self._run()
+        except Cancelled as c:
+            REQUESTS.inc(outcome="cancelled")
+            log(f"🛑 request {self.id} stopped ({c.reason})")
+            if c.reason == "superseded":
+                await self.say("⏭️ Dropped the previous request in favour of your new one.")
+            else:
+                await self.say("🛑 Cancelled.")
+        finally:
+            if active.get(self.user_id) is self:
+                del active[self.user_id]
+            self._release(self.paths)
+            profiler.finish(profile)
+
+    async def _run(self):
+        candidate_urls = self.candidate_urls
+        if candidate_urls is None:
+            candidate_urls = await self.collect()
+            if candidate_urls is None:
+                return
+        self.token.raise_if_cancelled()
 
-    memory = await load_ai_memory_threadsafe(user_id)
-    last_sent_urls = memory[0]["urls"] if memory else None
+        if not candidate_urls:
+            await self.say("⚠️ No videos found for that query.")
+            return
 
-    query, count, confirmation_prompt, alt_prompts = await parse_user_request(user_text, memory, last_sent_urls, user_id)
+        fresh = await ai_filter_fresh_urls(self.user_id, candidate_urls, self.count)
+        self.token.raise_if_cancelled()
+        if not fresh:
+            await self.say("⚠️ No new videos (already sent these).")
+            return
 
-    if not query or count <= 0:
-        await update.message.reply_text("I couldn't understand your request. Try something like: `send 5 funny edits`")
-        return
+        await self.say(f"⬇️ Downloading {len(fresh)} videos now...", reply_markup=self.cancel_markup())
+        try:
+            self.paths = list(await self.downloader_fn(fresh, cancel_token=self.token))
+        except Cancelled:
+            raise
+        except Exception as e:
+            log(f"[ERROR] download step: {e}")
+            await self.say("❌ Download failed.")
+            return
+        self.token.raise_if_cancelled()
 
-    if query == "__FOLLOWUP__" and last_sent_urls:
-        candidate_urls = last_sent_urls
-        await update.message.reply_text(confirmation_prompt)
-    else:
-        if confirmation_prompt:
-            buttons = [
-                [InlineKeyboardButton("✅ Yes", callback_data="confirm")],
-                [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-            ]
-            await update.message.reply_text(
-                confirmation_prompt,
-                reply_markup=InlineKeyboardMarkup(buttons)
-            )
-            context.user_data["awaiting_confirmation"] = True
-            context.user_data["pending_request"] = {
-                "user_text": user_text,
-                "query": query,
-                "count": count,
-            }
-            return  # ⬅️ stop here! don’t scrape yet
-
-        driver = context.bot_data.get("tiktok_driver")
-        if not driver:
-            await update.message.reply_text("⚠️ Scraper not available right now. Try again later.")
+        if not self.paths:
+            await self.say("❌ Downloads failed or returned no files.")
             return
 
+        mark_urls_sent_threadsafe(self.user_id, fresh)
+        save_ai_memory_threadsafe(self.user_id, self.user_text, fresh)
+        await self.upload()
+
+    async def collect(self):
+        token = self.token
+        if not getattr(self.collect_fn, "needs_driver", True):
+            # scraping happens on a worker (see worker.RemoteCollector)
+            return await self._run_collect(self.collect_fn(
+                [self.query],
+                per_query=self.count,
+                batch_limit=self.count,
+                cancel_token=token,
+            ))
+
+        driver = self.context.bot_data.get("tiktok_driver")
+        if not driver:
+            await self.say("⚠️ Scraper not available right now. Try again later.")
+            return None
+
         # Get the lock from bot_data
-        lock = context.bot_data.get("driver_lock")
+        lock = self.context.bot_data.get("driver_lock")
         if not lock:
-            await update.message.reply_text("⚠️ Lock not available for driver access.")
-            return
+            await self.say("⚠️ Lock not available for driver access.")
+            return None
 
         def collect_with_lock():
-            with lock:
-                return tiktok_collect_fn(driver, [query], per_query=count, batch_limit=count)
+            # poll so a cancelled request stops queueing for the driver
+            while not lock.acquire(timeout=0.5):
+                token.raise_if_cancelled()
+            try:
+                token.raise_if_cancelled()
+                return self.collect_fn(
+                    driver, [self.query],
+                    per_query=self.count,
+                    batch_limit=self.count,
+                    should_stop=token.is_set,
+                )
+            finally:
+                lock.release()
 
         loop = asyncio.get_running_loop()
+        return await self._run_collect(loop.run_in_executor(
+            None, contextvars.copy_context().run, profiler.tagged(collect_with_lock, "collect")
+        ))
+
+    async def _run_collect(self, pending):
         try:
-            candidate_urls = await loop.run_in_executor(None, collect_with_lock)
+            return await pending
+        except Cancelled:
+            raise
         except Exception as e:
             log(f"[ERROR] collecting URLs: {e}")
-            await update.message.reply_text("❌ Failed to collect video links.")
-            return
+            await self.say("❌ Failed to collect video links.")
+            return None
 
-    if not candidate_urls:
-        await update.message.reply_text("⚠️ No videos found for that query.")
-        return
+    async def upload(self):
+        cache = self.context.bot_data.get("disk_cache")
+        sent = 0
+        for path in list(self.paths):
+            self.token.raise_if_cancelled()
+            try:
+                with metrics.timer("upload"), open(path, "rb") as f:
+                    await self.context.bot.send_video(chat_id=self.chat_id, video=f)
+                sent += 1
+                if cache:
+                    cache.touch(path, sent=True)
+            except Exception as e:
+                UPLOAD_FAILURES.inc()
+                log(f"[WARNING] Failed sending {path}: {e}")
+            finally:
+                self.paths.remove(path)
+                self._release([path])
+        VIDEOS_SENT.inc(sent)
+        REQUESTS.inc(outcome="sent" if sent else "upload_failed")
+        await self.say(f"✅ Sent {sent} videos.")
+
+    def _release(self, paths):
+        cache = self.context.bot_data.get("disk_cache")
+        if cache:
+            for path in paths:
+                cache.release(path)
+
+
+def cancel_active_request(context, user_id, request_id=None, reason="cancelled"):
+    """Cancel the user's running pipeline (optionally only if it matches request_id)."""
+    pipeline = context.bot_data.get("active_pipelines", {}).get(user_id)
+    if pipeline and (request_id is None or pipeline.id == request_id):
+        pipeline.cancel(reason)
+        return True
+    return False
 
-    fresh = await ai_filter_fresh_urls(user_id, candidate_urls, count)
-    if not fresh:
-        await update.message.reply_text("⚠️ No new videos (already sent these).")
-        return
+# ---------------- High-level handler ----------------
+CONFIRMATION = range(1)
+PENDING_TEXT_MAX = 256   # chars of the original message kept for ai_memory
 
-    await update.message.reply_text(f"⬇️ Downloading {len(fresh)} videos now...")
+# ---- MODIFIED handle_user_request: added db_conn keyword ----
+async def handle_user_request(update: Update, context: ContextTypes.DEFAULT_TYPE, tiktok_collect_fn, downloader_fn, *, db_conn=None):
+    user_text = update.message.text or ""
+    user = update.effective_user
+    user_id = user.id
+    set_log_context(request_id=new_request_id(), user_id=user_id)
+    await update.message.chat.send_action("typing")
+    log(f"🤖 user asked: {user_text}")
 
-    try:
-        downloaded_paths = await downloader_fn(fresh)
-    except Exception as e:
-        log(f"[ERROR] download step: {e}")
-        await update.message.reply_text("❌ Download failed.")
-        return
+    memory = await load_ai_memory_threadsafe(user_id)
+    last = await load_last_memory_threadsafe(user_id)
+    last_sent_urls = last["urls"] if last else None
+
+    query, count, confirmation_prompt, alt_prompts = await parse_user_request(user_text, memory, last_sent_urls, user_id)
 
-    if not downloaded_paths:
-        await update.message.reply_text("❌ Downloads failed or returned no files.")
+    if not query or count <= 0:
+        await update.message.reply_text("I couldn't understand your request. Try something like: `send 5 funny edits`")
         return
 
-    mark_urls_sent_threadsafe(user_id, fresh)
-    save_ai_memory_threadsafe(user_id, user_text, fresh)
+    candidate_urls = None
+    if query == "__FOLLOWUP__" and last_sent_urls:
+        candidate_urls = last_sent_urls
+        await update.message.reply_text(confirmation_prompt)
+    elif confirmation_prompt:
+        token = context.bot_data["pending_store"].put(
+            user_id,
+            user_text=user_text[:PENDING_TEXT_MAX],
+            query=query,
+            count=count,
+        )
+        buttons = [
+            [InlineKeyboardButton("✅ Yes", callback_data=f"confirm:{token}")],
+            [InlineKeyboardButton("❌ Cancel", callback_data=f"cancel:{token}")]
+        ]
+        await update.message.reply_text(
+            confirmation_prompt,
+            reply_markup=InlineKeyboardMarkup(buttons)
+        )
+        return  # ⬅️ stop here! don’t scrape yet
 
-    sent = 0
-    for path in downloaded_paths:
-        try:
-            with open(path, "rb") as f:
-                await context.bot.send_video(chat_id=update.effective_chat.id, video=f)
-            sent += 1
-        except Exception as e:
-            log(f"[WARNING] Failed sending {path}: {e}")
-    await update.message.reply_text(f"✅ Sent {sent} videos.")
+    pipeline = RequestPipeline(
+        context, update.effective_chat.id, user_id, user_text, query, count,
+        tiktok_collect_fn, downloader_fn, candidate_urls=candidate_urls,
+    )
+    await pipeline.run()
 
 # ---------------- Confirmation button handler ----------------
 async def confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -878,120 +1675,193 @@ async def confirmation_callback(update: Update, context: ContextTypes.DEFAULT_TY
     except Exception as e:
         log(f"[CALLBACK ANSWER ERROR] {e}")
 
+    set_log_context(request_id=new_request_id(), user_id=update.effective_user.id)
     log(f"🔘 Button pressed: {query.data}")
 
-    if not context.user_data.get("awaiting_confirmation"):
+    # 🛑 on a running job works regardless of the confirmation state
+    if query.data and query.data.startswith("stop:"):
+        if cancel_active_request(context, update.effective_user.id, query.data.split(":", 1)[1]):
+            await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    action, _, token = (query.data or "").partition(":")
+    if action not in ("confirm", "cancel"):
         return
 
-    context.user_data["awaiting_confirmation"] = False
+    pending = context.bot_data["pending_store"].pop(token, update.effective_user.id)
+    if not pending:
+        await query.edit_message_text("⚠️ That request has expired, please send it again.")
+        return
 
-    if query.data == "confirm":
+    if action == "confirm":
         await query.edit_message_text("✅ Confirmed, working on your request...")
 
-        pending = context.user_data.get("pending_request")
-        if not pending:
-            await query.message.reply_text("⚠️ No pending request found.")
-            return
+        pipeline = RequestPipeline(
+            context, update.effective_chat.id, update.effective_user.id,
+            pending["user_text"], pending["query"], pending["count"],
+            context.application.bot_data["collect_fn"],
+            context.application.bot_data["downloader_fn"],
+        )
+        await pipeline.run()
 
-        driver = context.bot_data.get("tiktok_driver")
-        if not driver:
-            await query.message.reply_text("⚠️ Scraper not available right now. Try again later.")
-            return
+    else:
+        await query.edit_message_text("❌ Cancelled.")
 
-        # Get the lock from bot_data
-        lock = context.bot_data.get("driver_lock")
-        if not lock:
-            await query.message.reply_text("⚠️ Lock not available for driver access.")
-            return
+•== END bot.py ==•
 
-        def collect_with_lock():
-            with lock:
-                return context.application.bot_data["collect_fn"](
-                    driver, [pending["query"]],
-                    per_query=pending["count"],
-                    batch_limit=pending["count"]
-                )
 
-        loop = asyncio.get_running_loop()
-        try:
-            candidate_urls = await loop.run_in_executor(None, collect_with_lock)
-        except Exception as e:
-            log(f"[ERROR] collecting URLs: {e}")
-            await query.message.reply_text("❌ Failed to collect video links.")
-            return
-
-        if not candidate_urls:
-            await query.message.reply_text("⚠️ No videos found for that query.")
-            return
-
-        fresh = await ai_filter_fresh_urls(
-            update.effective_user.id,
-            candidate_urls,
-            pending["count"]
-        )
-
-        if not fresh:
-            await query.message.reply_text("⚠️ No new videos (already sent these).")
-            return
-
-        await query.message.reply_text(f"⬇️ Downloading {len(fresh)} videos now...")
-
-        try:
-            downloaded_paths = await context.application.bot_data["downloader_fn"](fresh)
-        except Exception as e:
-            log(f"[ERROR] download step: {e}")
-            await query.message.reply_text("❌ Download failed.")
-            return
+•== START downloader.py ==•
 
-        if not downloaded_paths:
-            await query.message.reply_text("❌ Downloads failed or returned no files.")
-            return
+import os
+import re
+import time
+import asyncio
+import contextvars
+import urllib.parse
+import yt_dlp
 
-        mark_urls_sent_threadsafe(update.effective_user.id, fresh)
-        save_ai_memory_threadsafe(update.effective_user.id, pending["user_text"], fresh)
+from config import NETSCAPE_COOKIES_FILE, log
+from concurrency import backoff_delay
+from cancel import Cancelled
+from profiler import profiler
+import metrics
+
+DOWNLOAD_FAILURES = metrics.counter("download_failures_total", "yt-dlp downloads that returned nothing")
+DOWNLOAD_RETRIES = metrics.counter("download_retries_total", "Download retries after a failure")
+BREAKER_SKIPS = metrics.counter("download_breaker_skips_total", "Downloads skipped by an open circuit breaker")
+
+THROTTLE_MARKERS = ("too many requests", "rate limit", "rate-limit")
+# status codes as whole numbers, so a video id like 7350042912... doesn't match
+THROTTLE_STATUS = re.compile(r"\b429\b")
+TRANSPORT_STATUS = re.compile(r"\b50[0234]\b")
+# network-level trouble: worth a retry and counts against the host.
+# Anything else (unavailable, private, removed, 404...) is about the video itself.
+TRANSPORT_MARKERS = (
+    "timed out", "timeout", "connection", "reset by peer", "temporary failure",
+    "name resolution", "remote end closed", "ssl",
+)
 
-        sent = 0
-        for path in downloaded_paths:
-            try:
-                with open(path, "rb") as f:
-                    await context.bot.send_video(chat_id=update.effective_chat.id, video=f)
-                sent += 1
-            except Exception as e:
-                log(f"[WARNING] Failed sending {path}: {e}")
-        await query.message.reply_text(f"✅ Sent {sent} videos.")
 
-    elif query.data == "cancel":
-        await query.edit_message_text("❌ Cancelled.")
+class DownloadFailed(Exception):
+    def __init__(self, url, reason, throttled=False, transient=None):
+        super().__init__(f"{url}: {reason}")
+        self.url = url
+        self.throttled = throttled
+        # throttling is always transient; content errors are not
+        self.transient = throttled if transient is None else (transient or throttled)
 
-•== END bot.py ==•
 
+def _is_transport_error(exc, reason):
+    # yt-dlp wraps the original exception in DownloadError.exc_info
+    original = (getattr(exc, "exc_info", None) or (None, None))[1] or exc.__cause__
+    if isinstance(original, OSError):   # ConnectionError, TimeoutError, URLError, ssl errors
+        return True
+    return any(m in reason for m in TRANSPORT_MARKERS) or bool(TRANSPORT_STATUS.search(reason))
 
-•== START downloader.py ==•
+OUTPUT_PATH = "downloads"
 
-import os
-import asyncio
-import yt_dlp
+# in-memory jar shared with the browser (see cookies.py); set by main
+_cookie_jar = None
 
-OUTPUT_PATH = "downloads"
+def use_cookie_jar(jar):
+    global _cookie_jar
+    _cookie_jar = jar
 
-async def download_video(url, outdir: str = OUTPUT_PATH):
-    """Download a single video with yt-dlp (async wrapper)."""
+@metrics.timed("download")
+async def fetch_video(url, outdir: str = OUTPUT_PATH, cancel_token=None):
+    """Download a single video with yt-dlp; raises DownloadFailed (or Cancelled)."""
     loop = asyncio.get_event_loop()
 
+    def _abort_if_cancelled(_progress):
+        # yt-dlp calls this for every chunk; raising aborts the transfer
+        if cancel_token is not None and cancel_token.is_set():
+            raise yt_dlp.utils.DownloadCancelled(cancel_token.reason)
+
     def _download():
         ydl_opts = {
             "outtmpl": os.path.join(outdir, "%(id)s.%(ext)s"),
             "quiet": True,
             "no_warnings": True,
+            "progress_hooks": [_abort_if_cancelled],
         }
+        jar = _cookie_jar
+        if jar is None and os.path.exists(NETSCAPE_COOKIES_FILE):
+            # no live jar yet: fall back to the file written at startup
+            ydl_opts["cookiefile"] = NETSCAPE_COOKIES_FILE
+        elif jar is not None and not jar.has_session():
+            log(f"[WARNING] no valid TikTok session cookies, downloading {url} anonymously")
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                if jar is not None:
+                    jar.apply_to(ydl)
                 info = ydl.extract_info(url, download=True)
                 return os.path.join(outdir, f"{info['id']}.{info['ext']}"), info
+        except yt_dlp.utils.DownloadCancelled:
+            raise Cancelled(cancel_token.reason if cancel_token else "cancelled")
         except Exception as e:
-            return None
+            reason = str(e)
+            lowered = reason.lower()
+            throttled = any(m in lowered for m in THROTTLE_MARKERS) or bool(THROTTLE_STATUS.search(lowered))
+            raise DownloadFailed(url, reason, throttled, _is_transport_error(e, lowered)) from e
+
+    # copy the context so yt-dlp log lines keep request_id/stage
+    return await loop.run_in_executor(None, contextvars.copy_context().run, profiler.tagged(_download, "download"))
+
+
+async def download_video(url, outdir: str = OUTPUT_PATH):
+    """Download a single video; returns (path, info) or None on failure."""
+    try:
+        return await fetch_video(url, outdir)
+    except DownloadFailed as e:
+        DOWNLOAD_FAILURES.inc()
+        log(f"[WARNING] yt-dlp failed for {e}")
+        return None
 
-    return await loop.run_in_executor(None, _download)
+
+async def download_with_policy(url, outdir, limiter, breaker, retries=2, backoff_base=2.0, cancel_token=None):
+    """
+    Download through the adaptive limiter and per-host circuit breaker,
+    retrying with exponential backoff outside the slot. Returns (path, info) or None.
+    Only throttling / transport errors are retried and count against the host
+    (once per url); content errors (unavailable, private, removed) fail fast.
+    """
+    host = urllib.parse.urlparse(url).netloc
+    counted = False
+    for attempt in range(retries + 1):
+        if cancel_token:
+            cancel_token.raise_if_cancelled()
+        if not breaker.allow(host):
+            BREAKER_SKIPS.inc()
+            log(f"[WARNING] circuit open for {host}, skipping {url}")
+            return None
+        async with limiter.slot():
+            if cancel_token:
+                cancel_token.raise_if_cancelled()
+            t0 = time.monotonic()
+            try:
+                r = await fetch_video(url, outdir, cancel_token)
+            except DownloadFailed as e:
+                err = e
+                if e.transient:
+                    limiter.record(False, throttled=e.throttled)
+                    breaker.record_failure(host, count=not counted)
+                    counted = True
+                else:
+                    breaker.release(host)
+            else:
+                limiter.record(True, latency=time.monotonic() - t0)
+                breaker.record_success(host)
+                return r
+        if not err.transient:
+            break
+        if attempt < retries:
+            DOWNLOAD_RETRIES.inc()
+            delay = backoff_delay(attempt, backoff_base)
+            log(f"🔁 retry {attempt + 1}/{retries} for {url} in {delay:.1f}s ({'429' if err.throttled else 'error'})")
+            await asyncio.sleep(delay)
+    DOWNLOAD_FAILURES.inc()
+    log(f"[WARNING] yt-dlp failed for {err}")
+    return None
 
 
 async def download_batch(urls, outdir: str = OUTPUT_PATH):
@@ -1013,3 +1883,2604 @@ async def limited_download(url, outdir, semaphore):
 
 •== END downloader.py ==•
 
+
+•== START cookies.py ==•
+
+# cookies.py
+"""
+Shared in-memory cookie jar. The browser session is the source of truth:
+a background thread pulls driver.get_cookies() every few minutes and every
+YoutubeDL instance gets a copy of the same jar, so no cookie file is
+rewritten per download.
+"""
+
+import copy
+import threading
+import time
+from http.cookiejar import Cookie, CookieJar
+
+from config import (
+    COOKIE_SYNC_INTERVAL,
+    COOKIE_EXPIRY_MARGIN,
+    log,
+)
+
+# cookies TikTok needs for an authenticated session
+AUTH_COOKIE_NAMES = ("sessionid", "sessionid_ss", "sid_tt", "sid_guard", "uid_tt")
+
+
+def _to_cookie(c):
+    """Selenium / JSON-export cookie dict -> http.cookiejar.Cookie."""
+    domain = c.get("domain") or ".tiktok.com"
+    expiry = c.get("expiry", c.get("expirationDate"))
+    return Cookie(
+        version=0,
+        name=c["name"],
+        value=c["value"],
+        port=None,
+        port_specified=False,
+        domain=domain,
+        domain_specified=True,
+        domain_initial_dot=domain.startswith("."),
+        path=c.get("path", "/"),
+        path_specified=True,
+        secure=bool(c.get("secure", False)),
+        expires=int(expiry) if expiry is not None else None,
+        discard=expiry is None,
+        comment=None,
+        comment_url=None,
+        rest={"HttpOnly": None} if c.get("httpOnly") else {},
+    )
+
+
+class SharedCookieJar:
+    """Single in-memory jar kept in sync with the Selenium session."""
+
+    def __init__(self, cookies=None):
+        self._lock = threading.Lock()
+        self._jar = CookieJar()
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_sync = 0.0
+        if cookies:
+            self.update(cookies)
+
+    def update(self, cookies):
+        """Merge a list of cookie dicts into the jar."""
+        with self._lock:
+            for c in cookies:
+                try:
+                    self._jar.set_cookie(_to_cookie(c))
+                except (KeyError, TypeError, ValueError):
+                    continue
+            self.last_sync = time.time()
+
+    def sync_from_driver(self, driver, driver_lock=None):
+        """Pull the current browser cookies. Returns number of cookies read."""
+        try:
+            if driver_lock:
+                with driver_lock:
+                    cookies = driver.get_cookies()
+            else:
+                cookies = driver.get_cookies()
+        except Exception as e:
+            log(f"[WARNING] cookie sync failed: {e}")
+            return 0
+        self.update(cookies)
+        return len(cookies)
+
+    def apply_to(self, ydl):
+        """Copy the jar into a YoutubeDL instance (no cookie file involved)."""
+        with self._lock:
+            cookies = [copy.copy(c) for c in self._jar]
+        for c in cookies:
+            ydl.cookiejar.set_cookie(c)
+
+    def expiring(self, margin=COOKIE_EXPIRY_MARGIN):
+        """Auth cookies that are expired or will expire within `margin` seconds."""
+        deadline = time.time() + margin
+        with self._lock:
+            return [
+                c.name for c in self._jar
+                if c.name in AUTH_COOKIE_NAMES and c.expires is not None and c.expires <= deadline
+            ]
+
+    def has_session(self):
+        now = time.time()
+        with self._lock:
+            return any(
+                c.name in AUTH_COOKIE_NAMES and (c.expires is None or c.expires > now)
+                for c in self._jar
+            )
+
+    # ---------------- background sync ----------------
+    def start_sync(self, driver, driver_lock=None, interval=COOKIE_SYNC_INTERVAL):
+        if self._thread and self._thread.is_alive():
+            return
+
+        def _loop():
+            while not self._stop.wait(interval):
+                n = self.sync_from_driver(driver, driver_lock)
+                soon = self.expiring()
+                if soon:
+                    log(f"[WARNING] TikTok session cookies expiring soon: {', '.join(soon)}")
+                elif n:
+                    log(f"🍪 Synced {n} cookies from browser")
+
+        self._thread = threading.Thread(target=_loop, name="cookie-sync", daemon=True)
+        self._thread.start()
+
+    def stop_sync(self):
+        self._stop.set()
+
+•== END cookies.py ==•
+
+•== START fake_bot_api.py ==•
+
+# fake_bot_api.py
+"""
+Local stand-in for the Telegram Bot API plus a webhook replayer, for
+end-to-end runs without Telegram.
+
+  1. python fake_bot_api.py serve --port 8081
+  2. TELEGRAM_API_BASE_URL=http://127.0.0.1:8081/bot WEBHOOK_URL=http://127.0.0.1:8443 \\
+     WEBHOOK_SECRET=test python main.py
+  3. python fake_bot_api.py replay updates.jsonl --webhook http://127.0.0.1:8443/telegram \\
+     --secret test --api http://127.0.0.1:8081
+
+Without --api, replay serves the fake API in-process on --port instead (then
+skip step 1). Recorded calls can be read back from GET /_calls?chat_id=&since=.
+
+Handler latency = time from POSTing an update to the first Bot API call the
+bot makes for that chat.
+"""
+
+import argparse
+import itertools
+import json
+import re
+import statistics
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot"}
+
+
+def _chat_id_of_update(update):
+    for key in ("message", "edited_message"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    if "callback_query" in update:
+        return update["callback_query"]["message"]["chat"]["id"]
+    return None
+
+
+class FakeBotAPI:
+    """Records every Bot API call; answers with minimal valid objects."""
+
+    def __init__(self, host="127.0.0.1", port=8081):
+        self.calls = []          # (ts, method, params)
+        self._lock = threading.Lock()
+        self._msg_ids = itertools.count(1000)
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def _handle(self):
+                if self.path.startswith("/_calls"):
+                    return self._send(api._calls_query(self.path))
+                m = re.match(r"/(?:file/)?bot[^/]+/(\w+)", self.path)
+                method = m.group(1) if m else ""
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                params = api._parse_params(self.headers.get("Content-Type", ""), body)
+                self._send({"ok": True, "result": api._result(method, params)})
+
+            def _send(self, obj):
+                payload = json.dumps(obj).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.base_url = f"http://{host}:{self.server.server_address[1]}"
+
+    @staticmethod
+    def _parse_params(content_type, body):
+        if not body:
+            return {}
+        if "json" in content_type:
+            return json.loads(body)
+        if "x-www-form-urlencoded" in content_type:
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        # multipart (file uploads): only pull out the plain fields we care about
+        params = {}
+        for name, value in re.findall(rb'name="(\w+)"\r\n\r\n([^\r]*)\r\n', body):
+            params[name.decode()] = value.decode(errors="replace")
+        params["_bytes"] = len(body)
+        return params
+
+    def _message(self, params):
+        chat_id = int(params.get("chat_id") or 0)
+        msg = {
+            "message_id": next(self._msg_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+        }
+        if "text" in params:
+            msg["text"] = params["text"]
+        if "reply_markup" in params:
+            markup = params["reply_markup"]
+            msg["reply_markup"] = json.loads(markup) if isinstance(markup, str) else markup
+        return msg
+
+    def _result(self, method, params):
+        with self._lock:
+            self.calls.append((time.time(), method, params))
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            time.sleep(0.5)   # don't let a polling bot spin
+            return []
+        if method in ("sendMessage", "sendVideo", "sendDocument", "editMessageText"):
+            return self._message(params)
+        return True
+
+    def calls_for(self, chat_id, since=0.0, method=None):
+        with self._lock:
+            return [
+                c for c in self.calls
+                if c[0] >= since
+                and str(c[2].get("chat_id")) == str(chat_id)
+                and (method is None or c[1] == method)
+            ]
+
+    def _calls_query(self, path):
+        """GET /_calls?chat_id=..&since=..&method=.. -> recorded calls as JSON."""
+        q = {k: v[0] for k, v in parse_qs(urlsplit(path).query).items()}
+        calls = self.calls_for(q.get("chat_id"), float(q.get("since", 0)), q.get("method"))
+        return [{"ts": ts, "method": method, "params": params} for ts, method, params in calls]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+
+# ---------------- webhook replay ----------------
+def load_updates(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def post_update(webhook_url, update, secret=None, timeout=10):
+    req = urllib.request.Request(webhook_url, data=json.dumps(update).encode(), method="POST")
+    req.add_header("Content-Type", "application/json")
+    if secret:
+        req.add_header("X-Telegram-Bot-Api-Secret-Token", secret)
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return resp.status
+
+
+def remote_calls_for(api_url, chat_id, since=0.0, method=None, timeout=5):
+    """Client side of /_calls, for a FakeBotAPI running in another process."""
+    q = {"chat_id": chat_id, "since": since}
+    if method:
+        q["method"] = method
+    with urllib.request.urlopen(f"{api_url.rstrip('/')}/_calls?{urlencode(q)}", timeout=timeout) as resp:
+        return [(c["ts"], c["method"], c["params"]) for c in json.loads(resp.read())]
+
+
+def replay(updates, webhook_url, first_call_fn, secret=None, interval=0.0, wait=30.0):
+    """
+    POST recorded updates to the bot's webhook and measure latency until the
+    bot's first Bot API call for the same chat. `first_call_fn(chat_id, since)`
+    returns the timestamp of that call or None.
+    """
+    sent = []
+    for u in updates:
+        u.setdefault("update_id", int(time.time() * 1000) % 2**31)
+        t0 = time.time()
+        post_update(webhook_url, u, secret)
+        sent.append((t0, _chat_id_of_update(u)))
+        if interval:
+            time.sleep(interval)
+
+    deadline = time.time() + wait
+    latencies = {}
+    while time.time() < deadline and len(latencies) < len(sent):
+        for i, (t0, chat_id) in enumerate(sent):
+            if i in latencies or chat_id is None:
+                continue
+            ts = first_call_fn(chat_id, t0)
+            if ts is not None:
+                latencies[i] = ts - t0
+        time.sleep(0.05)
+    return summarize(list(latencies.values()), len(sent))
+
+
+def summarize(latencies, total):
+    if not latencies:
+        return {"updates": total, "answered": 0}
+    lat = sorted(latencies)
+    pick = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))]
+    return {
+        "updates": total,
+        "answered": len(lat),
+        "mean_ms": round(statistics.mean(lat) * 1000, 1),
+        "p50_ms": round(pick(0.50) * 1000, 1),
+        "p95_ms": round(pick(0.95) * 1000, 1),
+        "max_ms": round(lat[-1] * 1000, 1),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake Telegram Bot API / webhook replayer")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    srv = sub.add_parser("serve")
+    srv.add_argument("--port", type=int, default=8081)
+    rep = sub.add_parser("replay")
+    rep.add_argument("updates")
+    rep.add_argument("--webhook", required=True)
+    rep.add_argument("--secret", default=None)
+    rep.add_argument("--api", default=None, help="base url of a running `serve`, e.g. http://127.0.0.1:8081")
+    rep.add_argument("--port", type=int, default=8081, help="without --api: serve the fake API in-process on this port")
+    rep.add_argument("--interval", type=float, default=0.0)
+    args = ap.parse_args()
+
+    if args.cmd == "serve":
+        api = FakeBotAPI(port=args.port).start()
+        print(f"fake Bot API on {api.base_url}/bot<token>/")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            return
+
+    if args.api:
+        calls_for = lambda chat_id, since: remote_calls_for(args.api, chat_id, since)
+    else:
+        calls_for = FakeBotAPI(port=args.port).start().calls_for
+
+    def first_call(chat_id, since):
+        calls = calls_for(chat_id, since)
+        return calls[0][0] if calls else None
+
+    stats = replay(load_updates(args.updates), args.webhook, first_call, args.secret, args.interval)
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
+
+•== END fake_bot_api.py ==•
+
+•== START metrics.py ==•
+
+# metrics.py
+"""
+In-process metrics: counters, gauges and latency histograms, exported in
+Prometheus text format on a local port and summarised by the /stats command.
+"""
+
+import asyncio
+import functools
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config import log, log_fields
+
+# seconds; covers a fast DB lookup up to a slow multi-video download
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+QUANTILES = (0.5, 0.95, 0.99)
+RECENT_SAMPLES = 1024    # per label set, used for p50/p95/p99
+
+_lock = threading.Lock()
+_metrics = {}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _fmt_labels(key, extra=None):
+    items = list(key) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, doc=""):
+        self.name, self.doc = name, doc
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def snapshot(self):
+        # executor threads add label keys while /metrics or /stats iterates
+        with _lock:
+            return list(self.values.items())
+
+    def render(self):
+        return [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self.snapshot()]
+
+
+class Gauge:
+    kind = "gauge"
+
+    def __init__(self, name, doc=""):
+        self.name, self.doc = name, doc
+        self.values = {}
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[_label_key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def snapshot(self):
+        # executor threads add label keys while /metrics or /stats iterates
+        with _lock:
+            return list(self.values.items())
+
+    def render(self):
+        return [f"{self.name}{_fmt_labels(k)} {v}" for k, v in self.snapshot()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, doc="", buckets=DEFAULT_BUCKETS):
+        self.name, self.doc = name, doc
+        self.buckets = tuple(buckets)
+        self.series = {}   # key -> [bucket_counts, count, sum, recent]
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with _lock:
+            s = self.series.get(key)
+            if s is None:
+                s = self.series[key] = [[0] * len(self.buckets), 0, 0.0, deque(maxlen=RECENT_SAMPLES)]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    s[0][i] += 1
+            s[1] += 1
+            s[2] += value
+            s[3].append(value)
+
+    def quantiles(self, **labels):
+        with _lock:
+            s = self.series.get(_label_key(labels))
+            recent = sorted(s[3]) if s else []
+        if not recent:
+            return {}
+        return {q: recent[min(len(recent) - 1, int(q * len(recent)))] for q in QUANTILES}
+
+    def snapshot(self):
+        with _lock:
+            return [(key, list(s[0]), s[1], s[2]) for key, s in self.series.items()]
+
+    def render(self):
+        lines = []
+        for key, counts, count, total in self.snapshot():
+            for b, c in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{_fmt_labels(key, {'le': b})} {c}")
+            lines.append(f"{self.name}_bucket{_fmt_labels(key, {'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_count{_fmt_labels(key)} {count}")
+            lines.append(f"{self.name}_sum{_fmt_labels(key)} {total:.6f}")
+        return lines
+
+
+def _get(cls, name, doc):
+    with _lock:
+        m = _metrics.get(name)
+        if m is None:
+            m = _metrics[name] = cls(name, doc)
+    return m
+
+
+def counter(name, doc=""):
+    return _get(Counter, name, doc)
+
+
+def gauge(name, doc=""):
+    return _get(Gauge, name, doc)
+
+
+def histogram(name, doc=""):
+    return _get(Histogram, name, doc)
+
+
+# ---------------- stage timing ----------------
+STAGE_SECONDS = histogram("stage_seconds", "Time spent per pipeline stage")
+STAGE_FAILURES = counter("stage_failures_total", "Exceptions raised per pipeline stage")
+
+
+@contextmanager
+def timer(stage):
+    t0 = time.perf_counter()
+    try:
+        with log_fields(stage=stage):
+            yield
+    except BaseException:
+        STAGE_FAILURES.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=stage)
+
+
+def timed(stage):
+    """Decorator recording duration/failures of a sync or async function."""
+    def wrap(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with timer(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return wrap
+
+
+# ---------------- export ----------------
+def render_prometheus():
+    lines = []
+    with _lock:
+        metrics = list(_metrics.values())
+    for m in metrics:
+        if m.doc:
+            lines.append(f"# HELP {m.name} {m.doc}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+
+def stats_text():
+    """Human summary for the /stats admin command."""
+    out = ["📊 Stage latency (p50 / p95 / p99, n)"]
+    for key, _counts, n, _total in sorted(STAGE_SECONDS.snapshot()):
+        labels = dict(key)
+        q = STAGE_SECONDS.quantiles(**labels)
+        out.append(
+            f"• {labels.get('stage')}: {q[0.5]:.2f}s / {q[0.95]:.2f}s / {q[0.99]:.2f}s, n={n}"
+        )
+    with _lock:
+        metrics = [m for m in _metrics.values() if m.kind in ("counter", "gauge")]
+    for m in metrics:
+        for key, v in m.snapshot():
+            out.append(f"• {m.name}{_fmt_labels(key)} = {v:g}")
+    return "\n".join(out)
+
+
+def start_server(port, host="127.0.0.1"):
+    """Serve /metrics on a background thread."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/metrics":
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = render_prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log(f"📈 metrics on http://{host}:{port}/metrics")
+    return server
+
+•== END metrics.py ==•
+
+•== START bench.py ==•
+
+# bench.py
+"""
+Offline end-to-end benchmark. Everything external is faked through the seams
+the bot already has:
+
+  * bot_data["collect_fn"] / ["tiktok_driver"] -> FakeDriver reading fixture search pages
+  * yt_dlp.YoutubeDL in downloader.fetch_video  -> FakeYoutubeDL fetching synthetic videos
+  * bot.openai                                  -> canned ChatCompletion answers
+  * Telegram                                    -> fake_bot_api.FakeBotAPI
+
+A local HTTP server serves the fixture pages (search_fixtures layouts with
+fresh ids, plus plain links for the DOM fallback) and video files. N simulated
+users send a message, press the first button of the reply, and we report
+requests/minute, time-to-first-video and per-stage latency. Downloads go
+through the real main.async_downloader / downloader.fetch_video path, so the
+limiter, retries and disk cache are part of the measurement. Exits non-zero
+if no request completed.
+
+  python bench.py --users 20 --videos 3
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import types
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from fake_bot_api import FakeBotAPI
+import search_fixtures
+
+VIDEO_ID_BASE = 7300000000000000000
+
+
+# ---------------- fixture server ----------------
+class FixtureServer:
+    """Serves /search?q=... pages with video links and /video/<id>.mp4 files."""
+
+    def __init__(self, links_per_page=12, video_bytes=256 * 1024, latency=0.0):
+        self.links_per_page = links_per_page
+        self.video = os.urandom(video_bytes)
+        self.latency = latency
+        fx = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if fx.latency:
+                    time.sleep(fx.latency)
+                if self.path.startswith("/search"):
+                    body = fx.search_page(self.path).encode()
+                    ctype = "text/html"
+                elif self.path.startswith("/video/"):
+                    body, ctype = fx.video, "video/mp4"
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def search_payload(self, layout="api"):
+        """A search_fixtures layout filled with fresh ids; returns (payload, urls)."""
+        # fresh ids on every hit so the already-sent filter doesn't empty the batch
+        ids = [str(VIDEO_ID_BASE + random.randrange(10**12)) for _ in range(self.links_per_page)]
+        views = [random.randrange(10**6) for _ in ids]
+        author = search_fixtures.author_of(layout)
+        urls = [f"https://www.tiktok.com/@{author}/video/{vid}" for vid in ids]
+        return search_fixtures.fresh_payload(layout, ids, views), urls
+
+    def search_page(self, path):
+        # alternate the embedded-state layouts between page loads
+        self._pages = getattr(self, "_pages", 0) + 1
+        layout = ("sigi", "universal")[self._pages % 2]
+        script_id = search_fixtures.STATE_SCRIPTS[layout][0]
+        payload, urls = self.search_payload(layout)
+        links = "".join(f'<a href="{u}">v</a>' for u in urls)
+        return (
+            f'<html><body><script id="{script_id}" type="application/json">'
+            f"{json.dumps(payload)}</script>{links}</body></html>"
+        )
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fixtures", daemon=True).start()
+        return self
+
+
+# ---------------- fake driver / collect ----------------
+class FakeElement:
+    def __init__(self, href):
+        self._href = href
+
+    def get_attribute(self, name):
+        return self._href if name == "href" else None
+
+
+class FakeDriver:
+    """Just enough of a Selenium driver for the search scrape."""
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.page = ""
+
+    def get(self, url):
+        q = url.split("q=", 1)[-1] if "q=" in url else ""
+        with urllib.request.urlopen(f"{self.fixtures.base_url}/search?q={q}") as resp:
+            self.page = resp.read().decode()
+
+    def find_elements(self, by, xpath):
+        return [FakeElement(h) for h in re.findall(r'href="([^"]+/video/\d+)"', self.page)]
+
+    def find_element(self, by, xpath):
+        # what WebDriverWait(...).until(presence_of_element_located) polls
+        from selenium.common.exceptions import NoSuchElementException
+        found = self.find_elements(by, xpath)
+        if not found:
+            raise NoSuchElementException(xpath)
+        return found[0]
+
+    def execute_script(self, script, *args):
+        import tiktok
+        if script == tiktok.READ_STATE_JS:
+            m = re.search(r'<script id="(?:%s)"[^>]*>(.*?)</script>' % "|".join(args[0]), self.page, re.S)
+            return m.group(1) if m else None
+        if script == tiktok.DRAIN_CAPTURE_JS:
+            # one more /api/search/general/full page per scroll
+            return json.dumps([self.fixtures.search_payload("api")[0]])
+        return None
+
+    def refresh(self):
+        pass
+
+    def get_cookies(self):
+        return []
+
+
+def fake_collect(driver, query_list, per_query=10, batch_limit=50, should_stop=None):
+    urls = []
+    for q in query_list:
+        if should_stop and should_stop():
+            break
+        driver.get(f"https://www.tiktok.com/search?q={urllib.parse.quote(q)}")
+        for e in driver.find_elements("xpath", "//a[contains(@href,'/video/')]"):
+            href = e.get_attribute("href")
+            if href not in urls:
+                urls.append(href)
+            if len(urls) >= min(per_query, batch_limit):
+                return urls
+    return urls
+
+
+# ---------------- fake yt-dlp ----------------
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL inside downloader.fetch_video."""
+
+    fixtures = None
+    chunk = 64 * 1024
+
+    def __init__(self, opts):
+        self.opts = opts
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def extract_info(self, url, download=True):
+        vid = url.rstrip("/").split("/")[-1]
+        path = self.opts["outtmpl"].replace("%(id)s", vid).replace("%(ext)s", "mp4")
+        with urllib.request.urlopen(f"{self.fixtures.base_url}/video/{vid}.mp4") as resp, open(path, "wb") as f:
+            while True:
+                data = resp.read(self.chunk)
+                if not data:
+                    break
+                f.write(data)
+                # progress hooks are where fetch_video checks for cancellation
+                for hook in self.opts.get("progress_hooks", []):
+                    hook({"status": "downloading", "filename": path})
+        return {"id": vid, "ext": "mp4"}
+
+
+def install_fake_ytdl(fixtures):
+    import downloader
+    fake = type("FakeYoutubeDL", (FakeYoutubeDL,), {"fixtures": fixtures})
+    # keep the real yt_dlp.utils so DownloadCancelled etc. still resolve
+    downloader.yt_dlp = types.SimpleNamespace(YoutubeDL=fake, utils=downloader.yt_dlp.utils)
+
+
+# ---------------- fake OpenAI ----------------
+def make_fake_openai(latency=0.3):
+    def create(model=None, messages=None, **_kwargs):
+        time.sleep(latency)
+        prompt = messages[-1]["content"]
+        if "Given these TikTok URLs" in prompt:
+            content = json.dumps(re.findall(r"https://www\.tiktok\.com/[^'\s,\]]+", prompt))
+        elif "alternative search prompts" in prompt:
+            m = re.search(r'User input: "(.*)"', prompt)
+            content = json.dumps([m.group(1) if m else "fyp"])
+        else:
+            m = re.search(r"'''(.*?)'''", prompt, re.S)
+            text = m.group(1) if m else ""
+            n = re.search(r"\d+", text)
+            content = json.dumps({"query": re.sub(r"\d+", "", text).strip() or "fyp",
+                                  "count": int(n.group(0)) if n else 3})
+        msg = types.SimpleNamespace(content=content)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=msg)])
+
+    return types.SimpleNamespace(ChatCompletion=types.SimpleNamespace(create=create))
+
+
+# ---------------- simulated users ----------------
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"user{uid}"}
+
+
+def _message_update(update_id, uid, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": _user(uid),
+            "text": text,
+        },
+    }
+
+
+def _callback_update(update_id, uid, bot_msg, data):
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": bot_msg["message_id"],
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "text": bot_msg.get("text", ""),
+            },
+        },
+    }
+
+
+def _first_button(params):
+    markup = params.get("reply_markup")
+    if isinstance(markup, str):
+        markup = json.loads(markup)
+    try:
+        return markup["inline_keyboard"][0][0]["callback_data"]
+    except (TypeError, KeyError, IndexError):
+        return None
+
+
+async def _wait_for(predicate, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        r = predicate()
+        if r:
+            return r
+        await asyncio.sleep(0.02)
+    return None
+
+
+async def simulate_user(app, api, uid, text, timeout):
+    from telegram import Update
+
+    res = {"uid": uid, "ok": False}
+    t0 = time.time()
+    await app.process_update(Update.de_json(_message_update(uid * 10, uid, text), app.bot))
+
+    def button():
+        for ts, method, params in api.calls_for(uid, t0, "sendMessage"):
+            data = _first_button(params)
+            if data:
+                return ts, data, params
+        return None
+
+    found = await _wait_for(button, timeout)
+    if not found:
+        return res
+    _ts, data, params = found
+    bot_msg = {"message_id": 1, "text": params.get("text", "")}
+    t_confirm = time.time()
+    res["confirm_prompt_s"] = t_confirm - t0
+    await app.process_update(Update.de_json(_callback_update(uid * 10 + 1, uid, bot_msg, data), app.bot))
+
+    def done():
+        for ts, method, params in api.calls_for(uid, t_confirm, "sendMessage"):
+            if str(params.get("text", "")).startswith(("✅ Sent", "⚠️", "❌")):
+                return ts, params["text"]
+        return None
+
+    finished = await _wait_for(done, timeout)
+    videos = api.calls_for(uid, t_confirm, "sendVideo")
+    if videos:
+        res["ttfv_s"] = videos[0][0] - t0
+    if finished:
+        res["ok"] = str(finished[1]).startswith("✅ Sent")
+        res["total_s"] = finished[0] - t0
+        res["videos"] = len(videos)
+    return res
+
+
+def _pct(values, q):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(q * len(values)))], 3) if values else None
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="tiktokbot-bench-")
+    os.chdir(workdir)   # per-user DBs, downloads/ and logs land here
+    os.environ.setdefault("LOG_FILE", "")
+    os.environ.setdefault("METRICS_PORT", "0")
+
+    fixtures = FixtureServer(video_bytes=args.video_kb * 1024, latency=args.fixture_latency).start()
+    api = FakeBotAPI(port=0).start()
+
+    import main as main_module
+    import bot as bot_module
+    import metrics
+
+    if args.openai:
+        bot_module.openai = make_fake_openai(args.openai_latency)
+        bot_module.OPENAI_AVAILABLE = True
+    else:
+        bot_module.OPENAI_AVAILABLE = False
+
+    from concurrency import AdaptiveLimiter
+    install_fake_ytdl(fixtures)
+    main_module.download_limiter = AdaptiveLimiter(
+        args.download_concurrency, min_limit=1, max_limit=max(args.download_concurrency, 1)
+    )
+
+    driver = FakeDriver(fixtures)
+    app = main_module.build_app("123:BENCH", driver, None, base_url=f"{api.base_url}/bot")
+    app.bot_data["driver_lock"] = threading.Lock()
+    if args.real_collect:
+        # tiktok.collect_batch_urls against the fixture pages (includes its page-load sleeps)
+        import tiktok
+        app.bot_data["collect_fn"] = tiktok.collect_batch_urls
+    else:
+        app.bot_data["collect_fn"] = metrics.timed("collect")(fake_collect)
+
+    async with app:
+        t0 = time.time()
+        results = await asyncio.gather(*(
+            simulate_user(app, api, 1000 + i, f"{args.videos} funny pranks", args.timeout)
+            for i in range(args.users)
+        ))
+        elapsed = time.time() - t0
+
+    ok = [r for r in results if r["ok"]]
+    ttfv = [r["ttfv_s"] for r in results if "ttfv_s" in r]
+    report = {
+        "users": args.users,
+        "completed": len(ok),
+        "elapsed_s": round(elapsed, 2),
+        "requests_per_min": round(len(ok) / elapsed * 60, 1) if elapsed else 0,
+        "ttfv_p50_s": _pct(ttfv, 0.5),
+        "ttfv_p95_s": _pct(ttfv, 0.95),
+        "ttfv_mean_s": round(statistics.mean(ttfv), 3) if ttfv else None,
+        "stages": {},
+    }
+    for key, _counts, n, _total in sorted(metrics.STAGE_SECONDS.snapshot()):
+        stage = dict(key).get("stage")
+        q = metrics.STAGE_SECONDS.quantiles(stage=stage)
+        report["stages"][stage] = {
+            "n": n,
+            "p50_s": round(q[0.5], 3), "p95_s": round(q[0.95], 3), "p99_s": round(q[0.99], 3),
+        }
+    return report
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Offline throughput benchmark")
+    ap.add_argument("--users", type=int, default=10)
+    ap.add_argument("--videos", type=int, default=3, help="videos requested per user")
+    ap.add_argument("--video-kb", type=int, default=256)
+    ap.add_argument("--download-concurrency", type=int, default=4, help="initial/max adaptive download limit")
+    ap.add_argument("--fixture-latency", type=float, default=0.0, help="seconds added per fixture request")
+    ap.add_argument("--real-collect", action="store_true",
+                    help="scrape fixture pages with tiktok.collect_batch_urls instead of the stub")
+    ap.add_argument("--openai", action="store_true", help="route prompts through the fake OpenAI")
+    ap.add_argument("--openai-latency", type=float, default=0.3)
+    ap.add_argument("--timeout", type=float, default=60.0)
+    args = ap.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if report["completed"] == 0:
+        sys.exit("bench: no request completed, the numbers above measure nothing (see the log)")
+
+
+if __name__ == "__main__":
+    main()
+
+•== END bench.py ==•
+
+•== START disk_cache.py ==•
+
+# disk_cache.py
+"""
+Byte-budgeted eviction for the downloads/ directory. Metadata (size, last
+access, send count) lives in a JSON manifest next to the files so startup
+only reads one file instead of stat-ing the whole directory. Files that are
+pinned (downloaded and waiting for / in the middle of an upload) are never
+evicted. Manifest writes are debounced onto a timer thread so a burst of
+downloads/uploads costs one write, not one per file on the event loop.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from config import log
+import metrics
+
+SAVE_DELAY = 5.0   # seconds between a change and the manifest write
+
+CACHE_BYTES = metrics.gauge("download_cache_bytes", "Bytes tracked in downloads/")
+CACHE_EVICTIONS = metrics.counter("download_cache_evictions_total", "Files evicted from downloads/")
+
+
+class DiskCache:
+    def __init__(self, root, budget_bytes, policy="lru", manifest=None, save_delay=SAVE_DELAY):
+        self.root = root
+        self.budget = budget_bytes
+        self.policy = policy
+        self.manifest = manifest or os.path.join(root, ".manifest.json")
+        self.entries = {}   # file name -> {"size", "last_access", "sends"}
+        self.pins = {}      # file name -> pin count
+        self.total = 0
+        self.save_delay = save_delay
+        self._lock = threading.Lock()
+        self._io_lock = threading.Lock()
+        self._dirty = False
+        self._save_timer = None
+        os.makedirs(root, exist_ok=True)
+        self.load()
+        atexit.register(self.flush)
+
+    # ---------------- manifest ----------------
+    def load(self):
+        try:
+            with open(self.manifest, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = self._scan()
+            log(f"🗂️ No cache manifest, indexed {len(self.entries)} files in {self.root}")
+        except (ValueError, OSError) as e:
+            log(f"[WARNING] cache manifest unreadable ({e}), rebuilding")
+            self.entries = self._scan()
+        self.total = sum(e["size"] for e in self.entries.values())
+        CACHE_BYTES.set(self.total)
+
+    def _scan(self):
+        """One-off directory walk, only when there is no manifest yet."""
+        entries = {}
+        with os.scandir(self.root) as it:
+            for d in it:
+                if d.is_file() and not d.name.startswith("."):
+                    st = d.stat()
+                    entries[d.name] = {"size": st.st_size, "last_access": st.st_mtime, "sends": 0}
+        return entries
+
+    def _save(self):
+        """Mark the manifest dirty (caller holds _lock); the write happens in flush()."""
+        self._dirty = True
+        if self._save_timer is None:
+            self._save_timer = threading.Timer(self.save_delay, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._save_timer = None
+            if not self._dirty:
+                return
+            self._dirty = False
+            data = json.dumps(self.entries)
+        with self._io_lock:
+            tmp = self.manifest + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+            os.replace(tmp, self.manifest)
+
+    # ---------------- bookkeeping ----------------
+    def add(self, path, pin=True):
+        """Track a freshly downloaded file (pinned until release) and enforce the budget."""
+        name = os.path.basename(path)
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        with self._lock:
+            old = self.entries.get(name)
+            if old:
+                self.total -= old["size"]
+            self.entries[name] = {"size": size, "last_access": time.time(), "sends": old["sends"] if old else 0}
+            self.total += size
+            if pin:
+                self.pins[name] = self.pins.get(name, 0) + 1
+            self._evict_locked()
+            self._save()
+        CACHE_BYTES.set(self.total)
+
+    def touch(self, path, sent=False):
+        name = os.path.basename(path)
+        with self._lock:
+            e = self.entries.get(name)
+            if e:
+                e["last_access"] = time.time()
+                if sent:
+                    e["sends"] += 1
+                    self._save()
+
+    def release(self, path):
+        name = os.path.basename(path)
+        with self._lock:
+            n = self.pins.get(name, 0) - 1
+            if n > 0:
+                self.pins[name] = n
+            else:
+                self.pins.pop(name, None)
+
+    # ---------------- eviction ----------------
+    def _victim_key(self, name):
+        e = self.entries[name]
+        if self.policy == "lfu":
+            return (e["sends"], e["last_access"])
+        return e["last_access"]
+
+    def _evict_locked(self):
+        if self.total <= self.budget:
+            return
+        candidates = sorted((n for n in self.entries if n not in self.pins), key=self._victim_key)
+        for name in candidates:
+            if self.total <= self.budget:
+                break
+            try:
+                os.remove(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                # still on disk, so it still counts against the budget
+                log(f"[WARNING] could not evict {name}: {err}")
+                continue
+            self.total -= self.entries.pop(name)["size"]
+            CACHE_EVICTIONS.inc()
+        if self.total > self.budget:
+            log(f"[WARNING] downloads/ over budget ({self.total} > {self.budget} bytes), remaining files are pinned")
+
+•== END disk_cache.py ==•
+
+•== START concurrency.py ==•
+
+# concurrency.py
+"""
+Runtime-sized download concurrency. AdaptiveLimiter grows the limit slowly
+while downloads succeed within the latency target and halves it on 429s
+(AIMD). CircuitBreaker stops sending work to a host that keeps failing, and
+backoff_delay spaces out retries so they don't sit on a slot while waiting.
+"""
+
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from config import log
+import metrics
+
+LIMIT_GAUGE = metrics.gauge("download_limit", "Current adaptive download concurrency limit")
+IN_FLIGHT = metrics.gauge("download_in_flight", "Downloads currently running")
+WAITING = metrics.gauge("download_queue_depth", "Downloads waiting for a slot")
+DECISIONS = metrics.counter("download_limit_decisions_total", "Limiter adjustments by reason")
+BREAKER_STATE = metrics.gauge("circuit_open", "1 while the breaker for a host is open")
+
+
+class AdaptiveLimiter:
+    def __init__(self, initial, min_limit=1, max_limit=10, latency_target=60.0,
+                 backoff=0.5, cooldown=5.0, window=20, error_threshold=0.5):
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.backoff = backoff              # multiplicative decrease factor
+        self.cooldown = cooldown            # min seconds between decreases
+        self.error_threshold = error_threshold
+        self.outcomes = deque(maxlen=window)
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+        LIMIT_GAUGE.set(int(self.limit))
+
+    @asynccontextmanager
+    async def slot(self):
+        WAITING.inc()
+        try:
+            async with self._cond:
+                while self.in_flight >= int(self.limit):
+                    await self._cond.wait()
+                self.in_flight += 1
+        finally:
+            WAITING.dec()
+        IN_FLIGHT.set(self.in_flight)
+        try:
+            yield self
+        finally:
+            async with self._cond:
+                self.in_flight -= 1
+                self._cond.notify_all()
+            IN_FLIGHT.set(self.in_flight)
+
+    # ---------------- feedback ----------------
+    def record(self, ok, latency=None, throttled=False):
+        self.outcomes.append(ok)
+        if throttled:
+            self._decrease("throttled")
+        elif not ok:
+            errors = self.outcomes.count(False)
+            if len(self.outcomes) >= 5 and errors / len(self.outcomes) >= self.error_threshold:
+                self._decrease("error_rate")
+        elif latency is not None and self.latency_target and latency > self.latency_target:
+            self._decrease("latency")
+        else:
+            # additive increase: roughly +1 per `limit` successes
+            old = int(self.limit)
+            self.limit = min(self.max_limit, self.limit + 1.0 / max(self.limit, 1.0))
+            if int(self.limit) > old:
+                DECISIONS.inc(reason="increase")
+                self._publish()
+
+    def _decrease(self, reason):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return   # one cut per burst of failures from the same congestion event
+        self._last_decrease = now
+        old = self.limit
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        DECISIONS.inc(reason=reason)
+        log(f"📉 download limit {int(old)} -> {int(self.limit)} ({reason})")
+        self._publish()
+
+    def _publish(self):
+        LIMIT_GAUGE.set(int(self.limit))
+
+        async def _wake():
+            async with self._cond:
+                self._cond.notify_all()
+        try:
+            asyncio.get_running_loop().create_task(_wake())
+        except RuntimeError:
+            pass
+
+
+class CircuitBreaker:
+    """closed -> open after `threshold` consecutive failures -> half-open after `reset_after`."""
+
+    def __init__(self, threshold=5, reset_after=60.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = {}      # host -> consecutive failures
+        self.opened_at = {}     # host -> monotonic time the breaker opened
+        self.probing = set()    # hosts with a half-open trial in flight
+
+    def allow(self, host):
+        opened = self.opened_at.get(host)
+        if opened is None:
+            return True
+        if time.monotonic() - opened < self.reset_after or host in self.probing:
+            return False
+        self.probing.add(host)   # half-open: let one request through
+        return True
+
+    def record_success(self, host):
+        self.failures.pop(host, None)
+        self.probing.discard(host)
+        if self.opened_at.pop(host, None) is not None:
+            log(f"🔌 circuit closed for {host}")
+            BREAKER_STATE.set(0, host=host)
+
+    def record_failure(self, host, count=True):
+        """count=False: a retry of a url already counted; only a failed half-open probe matters."""
+        n = self.failures.get(host, 0) + (1 if count else 0)
+        self.failures[host] = n
+        was_probe = host in self.probing
+        self.probing.discard(host)
+        if was_probe or (n >= self.threshold and host not in self.opened_at):
+            self.opened_at[host] = time.monotonic()
+            log(f"[WARNING] circuit open for {host} after {n} failures")
+            BREAKER_STATE.set(1, host=host)
+
+    def release(self, host):
+        """The request says nothing about the host's health (e.g. video removed): free a probe slot."""
+        self.probing.discard(host)
+
+
+def backoff_delay(attempt, base=2.0, cap=60.0):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+•== END concurrency.py ==•
+
+•== START cancel.py ==•
+
+# cancel.py
+"""Cancellation token shared by the event loop, executor threads and yt-dlp hooks."""
+
+import threading
+
+
+class Cancelled(Exception):
+    def __init__(self, reason="cancelled"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.reason = None
+
+    def cancel(self, reason="cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise Cancelled(self.reason)
+
+•== END cancel.py ==•
+
+•== START pending.py ==•
+
+# pending.py
+"""
+Requests waiting for the user to press ✅/❌. Only the parsed fields are
+kept, keyed by a short token that goes into the button's callback_data.
+Entries expire after a TTL, the store is capped (oldest evicted first) and
+can be mirrored to SQLite so confirmations survive a restart.
+"""
+
+import json
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from config import log
+import metrics
+
+PENDING_SIZE = metrics.gauge("pending_requests", "Requests waiting for confirmation")
+PENDING_EVICTIONS = metrics.counter("pending_evictions_total", "Pending requests dropped by reason")
+
+
+class PendingStore:
+    def __init__(self, ttl=600, max_items=5000, db_path=None):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()   # token -> (expires_at, user_id, fields)
+        self._by_user = {}            # user_id -> token (one pending request per user)
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS pending_requests (
+                token TEXT PRIMARY KEY,
+                user_id INTEGER,
+                payload TEXT,
+                expires_at REAL
+            )""")
+            self._db.commit()
+            self._load()
+
+    def _load(self):
+        now = time.time()
+        self._db.execute("DELETE FROM pending_requests WHERE expires_at <= ?", (now,))
+        self._db.commit()
+        rows = self._db.execute(
+            "SELECT token, user_id, payload, expires_at FROM pending_requests ORDER BY expires_at"
+        ).fetchall()
+        for token, user_id, payload, expires_at in rows:
+            self._items[token] = (expires_at, user_id, json.loads(payload))
+            self._by_user[user_id] = token
+        if rows:
+            log(f"⏳ Restored {len(rows)} pending requests")
+        PENDING_SIZE.set(len(self._items))
+
+    def put(self, user_id, **fields):
+        """Store a request for `user_id`, replacing any older one. Returns its token."""
+        token = secrets.token_urlsafe(6)
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            old = self._by_user.get(user_id)
+            if old:
+                self._drop(old, "replaced")
+            self._purge_expired()
+            while len(self._items) >= self.max_items:
+                oldest = next(iter(self._items))
+                self._drop(oldest, "capacity")
+            self._items[token] = (expires_at, user_id, fields)
+            self._by_user[user_id] = token
+            if self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO pending_requests (token, user_id, payload, expires_at) VALUES (?, ?, ?, ?)",
+                    (token, user_id, json.dumps(fields), expires_at),
+                )
+                self._db.commit()
+        PENDING_SIZE.set(len(self._items))
+        return token
+
+    def pop(self, token, user_id):
+        """Take the request behind `token` if it belongs to `user_id` and hasn't expired."""
+        with self._lock:
+            item = self._items.get(token)
+            if not item or item[1] != user_id:
+                return None
+            self._drop(token, None)
+        PENDING_SIZE.set(len(self._items))
+        expires_at, _user_id, fields = item
+        if expires_at <= time.time():
+            PENDING_EVICTIONS.inc(reason="expired")
+            return None
+        return fields
+
+    def _purge_expired(self):
+        now = time.time()
+        # insertion order == expiry order (constant TTL)
+        while self._items:
+            token, (expires_at, _u, _f) = next(iter(self._items.items()))
+            if expires_at > now:
+                break
+            self._drop(token, "expired")
+
+    def _drop(self, token, reason):
+        expires_at, user_id, _fields = self._items.pop(token)
+        if self._by_user.get(user_id) == token:
+            del self._by_user[user_id]
+        if reason:
+            PENDING_EVICTIONS.inc(reason=reason)
+        if self._db:
+            self._db.execute("DELETE FROM pending_requests WHERE token = ?", (token,))
+            self._db.commit()
+
+•== END pending.py ==•
+
+•== START jobqueue.py ==•
+
+# jobqueue.py
+"""
+Durable job queue between the bot frontend and scraper/download workers.
+Workers claim a job with a lease and keep it alive with heartbeats; a job
+whose lease runs out (worker died) goes back to the queue until it runs out
+of attempts. The frontend polls for the result.
+
+The default backend is a SQLite file (WAL mode), which is enough for several
+worker processes on one box or hosts sharing a filesystem. Other backends
+register themselves with register_backend().
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    payload: dict
+    attempts: int
+
+
+class JobQueue:
+    """Interface every backend implements."""
+
+    def enqueue(self, kind, payload, max_attempts=3):
+        raise NotImplementedError
+
+    def claim(self, worker_id, kinds, lease_seconds):
+        """Lease the oldest runnable job of one of `kinds`, or return None."""
+        raise NotImplementedError
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        """Extend the lease. False means the job was cancelled or re-assigned."""
+        raise NotImplementedError
+
+    def complete(self, job_id, worker_id, result):
+        raise NotImplementedError
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        raise NotImplementedError
+
+    def cancel(self, job_id):
+        raise NotImplementedError
+
+    def status(self, job_id):
+        """(status, result, error) for a job."""
+        raise NotImplementedError
+
+    def purge(self, older_than):
+        """Delete finished jobs last updated more than `older_than` seconds ago."""
+        raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            payload TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            max_attempts INTEGER DEFAULT 3,
+            worker TEXT,
+            lease_until REAL,
+            result TEXT,
+            error TEXT,
+            created REAL,
+            updated REAL
+        )""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs (status, kind, id)")
+        conn.commit()
+
+    def _conn(self):
+        # one connection per thread; isolation_level=None so BEGIN IMMEDIATE is explicit
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, kind, payload, max_attempts=3):
+        now = time.time()
+        cur = self._conn().execute(
+            "INSERT INTO jobs (kind, payload, status, max_attempts, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, json.dumps(payload), QUEUED, max_attempts, now, now),
+        )
+        return cur.lastrowid
+
+    def claim(self, worker_id, kinds, lease_seconds):
+        conn = self._conn()
+        now = time.time()
+        marks = ",".join("?" * len(kinds))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # expired leases that used up their attempts are dead, not runnable
+            conn.execute(
+                f"UPDATE jobs SET status=?, error='lease expired', updated=? "
+                f"WHERE status=? AND lease_until < ? AND attempts >= max_attempts AND kind IN ({marks})",
+                (FAILED, now, RUNNING, now, *kinds),
+            )
+            row = conn.execute(
+                f"SELECT id, kind, payload, attempts FROM jobs "
+                f"WHERE kind IN ({marks}) AND (status=? OR (status=? AND lease_until < ?)) "
+                f"ORDER BY id LIMIT 1",
+                (*kinds, QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            job_id, kind, payload, attempts = row
+            conn.execute(
+                "UPDATE jobs SET status=?, worker=?, lease_until=?, attempts=attempts+1, updated=? WHERE id=?",
+                (RUNNING, worker_id, now + lease_seconds, now, job_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return Job(job_id, kind, json.loads(payload), attempts + 1)
+
+    def heartbeat(self, job_id, worker_id, lease_seconds):
+        now = time.time()
+        cur = self._conn().execute(
+            "UPDATE jobs SET lease_until=?, updated=? WHERE id=? AND worker=? AND status=?",
+            (now + lease_seconds, now, job_id, worker_id, RUNNING),
+        )
+        return cur.rowcount == 1
+
+    def complete(self, job_id, worker_id, result):
+        self._conn().execute(
+            "UPDATE jobs SET status=?, result=?, lease_until=NULL, updated=? WHERE id=? AND worker=? AND status=?",
+            (DONE, json.dumps(result), time.time(), job_id, worker_id, RUNNING),
+        )
+
+    def fail(self, job_id, worker_id, error, retry=True):
+        conn = self._conn()
+        row = conn.execute("SELECT attempts, max_attempts FROM jobs WHERE id=?", (job_id,)).fetchone()
+        again = retry and row is not None and row[0] < row[1]
+        conn.execute(
+            "UPDATE jobs SET status=?, error=?, worker=NULL, lease_until=NULL, updated=? "
+            "WHERE id=? AND worker=? AND status=?",
+            (QUEUED if again else FAILED, str(error), time.time(), job_id, worker_id, RUNNING),
+        )
+
+    def cancel(self, job_id):
+        self._conn().execute(
+            f"UPDATE jobs SET status=?, updated=? WHERE id=? AND status NOT IN ({','.join('?' * len(FINISHED))})",
+            (CANCELLED, time.time(), job_id, *FINISHED),
+        )
+
+    def status(self, job_id):
+        row = self._conn().execute("SELECT status, result, error FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if row is None:
+            return None, None, "unknown job"
+        status, result, error = row
+        return status, json.loads(result) if result else None, error
+
+    def purge(self, older_than):
+        cur = self._conn().execute(
+            f"DELETE FROM jobs WHERE status IN ({','.join('?' * len(FINISHED))}) AND updated < ?",
+            (*FINISHED, time.time() - older_than),
+        )
+        return cur.rowcount
+
+
+_BACKENDS = {"sqlite": SQLiteJobQueue}
+
+
+def register_backend(scheme, factory):
+    """factory(location) -> JobQueue, selected by JOB_QUEUE_URL = '<scheme>://<location>'."""
+    _BACKENDS[scheme] = factory
+
+
+def open_job_queue(url):
+    scheme, sep, location = url.partition("://")
+    if not sep:
+        scheme, location = "sqlite", url
+    if scheme not in _BACKENDS:
+        raise ValueError(f"unknown job queue backend: {scheme}")
+    if scheme == "sqlite" and sep:
+        # sqlite:///jobs.db (relative) or sqlite:////var/lib/bot/jobs.db (absolute)
+        location = location[1:] if location.startswith("/") else location
+    return _BACKENDS[scheme](location)
+
+•== END jobqueue.py ==•
+
+•== START worker.py ==•
+
+# worker.py
+"""
+Scraper/download workers and the frontend callables that hand work to them.
+
+  python main.py --mode frontend   # Telegram only, enqueues collect/download jobs
+  python main.py --mode worker     # owns a browser + yt-dlp, runs jobs
+  python main.py                   # both in one process (default, no queue)
+
+The frontend serves /metrics on METRICS_PORT. Workers only do so when
+WORKER_METRICS_PORT is set, so several can run on one box; give each its own:
+
+  WORKER_METRICS_PORT=9111 python main.py --mode worker
+  WORKER_METRICS_PORT=9112 WORKER_BROWSER=0 python main.py --mode worker
+
+Downloaded files are written to OUTPUT_PATH, so frontend and workers must
+share that directory (same box, or a shared mount across hosts).
+"""
+
+import asyncio
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    TIKTOK_COOKIES_JSON,
+    NETSCAPE_COOKIES_FILE,
+    OUTPUT_PATH,
+    MAX_CONCURRENT_DOWNLOADS,
+    MIN_CONCURRENT_DOWNLOADS,
+    INITIAL_CONCURRENT_DOWNLOADS,
+    DOWNLOAD_LATENCY_TARGET,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_BACKOFF_BASE,
+    BREAKER_FAILURES,
+    BREAKER_RESET,
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_INTERVAL,
+    JOB_TIMEOUT,
+    JOB_RETENTION,
+    WORKER_DOWNLOAD_SLOTS,
+    log,
+)
+from tiktok import (
+    setup_browser,
+    load_cookies_from_file,
+    apply_cookies,
+    convert_json_to_netscape,
+    collect_batch_urls,
+)
+from cookies import SharedCookieJar
+from concurrency import AdaptiveLimiter, CircuitBreaker
+from cancel import Cancelled, CancelToken
+from jobqueue import DONE, FAILED, CANCELLED, FINISHED
+from transcode import transcoder
+import downloader
+import metrics
+
+JOBS_DONE = metrics.counter("worker_jobs_total", "Jobs finished by this worker, by kind and outcome")
+
+
+def start_browser_session():
+    """Browser with cookies applied, its lock, and the cookie jar shared with yt-dlp."""
+    driver = setup_browser()
+    cookies = load_cookies_from_file(TIKTOK_COOKIES_JSON)
+    log("✅ Loading cookies from file...")
+    log(f"✅ Loaded {len(cookies)} cookies")
+    apply_cookies(driver, cookies)
+    convert_json_to_netscape(TIKTOK_COOKIES_JSON, NETSCAPE_COOKIES_FILE)
+
+    # Create a lock for the driver to ensure thread-safe access
+    driver_lock = threading.Lock()
+
+    # one cookie jar for browser + yt-dlp, refreshed from the live session
+    cookie_jar = SharedCookieJar(cookies)
+    cookie_jar.sync_from_driver(driver, driver_lock)
+    expiring = cookie_jar.expiring()
+    if expiring:
+        log(f"[WARNING] TikTok session cookies expiring soon: {', '.join(expiring)}")
+    cookie_jar.start_sync(driver, driver_lock)
+    downloader.use_cookie_jar(cookie_jar)
+    return driver, driver_lock, cookie_jar
+
+
+def load_download_cookies():
+    """Cookies for yt-dlp without a browser (download-only workers): Netscape file + a static jar."""
+    try:
+        cookies = load_cookies_from_file(TIKTOK_COOKIES_JSON)
+        convert_json_to_netscape(TIKTOK_COOKIES_JSON, NETSCAPE_COOKIES_FILE)
+    except (OSError, ValueError) as e:
+        log(f"[WARNING] no TikTok cookies for yt-dlp ({e}), downloads will be anonymous")
+        return None
+    cookie_jar = SharedCookieJar(cookies)
+    expiring = cookie_jar.expiring()
+    if expiring:
+        log(f"[WARNING] TikTok session cookies expiring soon: {', '.join(expiring)}")
+    downloader.use_cookie_jar(cookie_jar)
+    return cookie_jar
+
+
+# ---------------- frontend side ----------------
+class RemoteCollector:
+    """collect_fn stand-in: runs the scrape on a worker. Awaited on the event loop, like RemoteDownloader."""
+    needs_driver = False
+
+    def __init__(self, queue, timeout=JOB_TIMEOUT):
+        self.queue = queue
+        self.timeout = timeout
+
+    async def __call__(self, query_list, per_query=10, batch_limit=50, cancel_token=None):
+        job_id = await asyncio.to_thread(
+            self.queue.enqueue,
+            "collect",
+            {"queries": list(query_list), "per_query": per_query, "batch_limit": batch_limit},
+            max_attempts=JOB_MAX_ATTEMPTS,
+        )
+        deadline = time.monotonic() + self.timeout
+        while True:
+            status, result, error = await asyncio.to_thread(self.queue.status, job_id)
+            if status == DONE:
+                return result["urls"]
+            if status in (FAILED, CANCELLED):
+                raise RuntimeError(f"collect job {job_id} {status}: {error}")
+            if cancel_token and cancel_token.is_set():
+                await asyncio.to_thread(self.queue.cancel, job_id)
+                cancel_token.raise_if_cancelled()
+            if time.monotonic() > deadline:
+                await asyncio.to_thread(self.queue.cancel, job_id)
+                raise TimeoutError(f"collect job {job_id} timed out")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+
+class RemoteDownloader:
+    """downloader_fn stand-in: one download job per url so workers share a batch."""
+
+    def __init__(self, queue, disk_cache=None, timeout=JOB_TIMEOUT):
+        self.queue = queue
+        self.disk_cache = disk_cache
+        self.timeout = timeout
+
+    async def __call__(self, urls, cancel_token=None):
+        def enqueue_all():
+            return {self.queue.enqueue("download", {"url": u}, max_attempts=JOB_MAX_ATTEMPTS): u for u in urls}
+
+        job_urls = await asyncio.to_thread(enqueue_all)
+        pending = set(job_urls)
+        out = []
+        deadline = time.monotonic() + self.timeout
+        while pending:
+            if (cancel_token and cancel_token.is_set()) or time.monotonic() > deadline:
+                await asyncio.to_thread(lambda: [self.queue.cancel(j) for j in pending])
+                if cancel_token and cancel_token.is_set():
+                    # nobody will upload these; unpin so they can be evicted
+                    if self.disk_cache:
+                        for path in out:
+                            self.disk_cache.release(path)
+                    cancel_token.raise_if_cancelled()
+                log(f"[WARNING] {len(pending)} download jobs timed out")
+                break
+            statuses = await asyncio.to_thread(lambda: {j: self.queue.status(j) for j in pending})
+            for job_id, (status, result, error) in statuses.items():
+                if status not in FINISHED:
+                    continue
+                pending.discard(job_id)
+                if status == DONE and result and result.get("path"):
+                    if self.disk_cache:
+                        if result.get("source"):
+                            self.disk_cache.add(result["source"], pin=False)
+                        # pinned until the upload releases it
+                        self.disk_cache.add(result["path"])
+                    out.append(result["path"])
+                elif status == DONE:
+                    log(f"[WARNING] download job {job_id} finished without a file for {job_urls[job_id]}")
+                elif error:
+                    log(f"[WARNING] download job {job_id} {status}: {error}")
+            if pending:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+        return out
+
+
+# ---------------- worker side ----------------
+class Worker:
+    def __init__(self, queue, driver=None, driver_lock=None, worker_id=None,
+                 download_slots=WORKER_DOWNLOAD_SLOTS, lease_seconds=JOB_LEASE_SECONDS):
+        self.queue = queue
+        self.driver = driver
+        self.driver_lock = driver_lock or threading.Lock()
+        self.id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.download_slots = download_slots
+        self.lease = lease_seconds
+        self.limiter = AdaptiveLimiter(
+            min(INITIAL_CONCURRENT_DOWNLOADS, download_slots),
+            min_limit=MIN_CONCURRENT_DOWNLOADS,
+            max_limit=min(MAX_CONCURRENT_DOWNLOADS, download_slots),
+            latency_target=DOWNLOAD_LATENCY_TARGET,
+        )
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_RESET)
+        # the driver is single-threaded: one scrape at a time
+        self._scrape_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scrape")
+        self._collecting = False
+        self._downloads = 0
+        self._stop = asyncio.Event()
+
+    def stop(self):
+        self._stop.set()
+
+    async def run(self):
+        log(f"👷 worker {self.id} started (driver={'yes' if self.driver else 'no'}, slots={self.download_slots})")
+        tasks = set()
+        last_purge = 0.0
+        while not self._stop.is_set():
+            kinds = []
+            if self.driver is not None and not self._collecting:
+                kinds.append("collect")
+            if self._downloads < self.download_slots:
+                kinds.append("download")
+            job = await asyncio.to_thread(self.queue.claim, self.id, kinds, self.lease) if kinds else None
+            if job is None:
+                if time.monotonic() - last_purge > 3600:
+                    last_purge = time.monotonic()
+                    await asyncio.to_thread(self.queue.purge, JOB_RETENTION)
+                try:
+                    await asyncio.wait_for(self._stop.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if job.kind == "collect":
+                self._collecting = True
+            else:
+                self._downloads += 1
+            task = asyncio.create_task(self._execute(job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _execute(self, job):
+        token = CancelToken()
+        heartbeat = asyncio.create_task(self._heartbeat(job, token))
+        outcome = "done"
+        try:
+            if job.kind == "collect":
+                result = {"urls": await self._collect(job.payload, token)}
+            else:
+                result = await self._download(job.payload, token)
+            token.raise_if_cancelled()
+            await asyncio.to_thread(self.queue.complete, job.id, self.id, result)
+        except Cancelled as c:
+            outcome = "cancelled"
+            log(f"🛑 job {job.id} stopped ({c.reason})")
+        except Exception as e:
+            outcome = "failed"
+            log(f"[ERROR] job {job.id} ({job.kind}) failed: {e}")
+            await asyncio.to_thread(self.queue.fail, job.id, self.id, str(e))
+        finally:
+            heartbeat.cancel()
+            if job.kind == "collect":
+                self._collecting = False
+            else:
+                self._downloads -= 1
+            JOBS_DONE.inc(kind=job.kind, outcome=outcome)
+
+    async def _heartbeat(self, job, token):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            alive = await asyncio.to_thread(self.queue.heartbeat, job.id, self.id, self.lease)
+            if not alive:
+                # cancelled by the frontend, or our lease expired and someone else has it
+                token.cancel("lease lost")
+                return
+
+    async def _collect(self, payload, token):
+        def run():
+            with self.driver_lock:
+                return collect_batch_urls(
+                    self.driver, payload["queries"],
+                    per_query=payload["per_query"],
+                    batch_limit=payload["batch_limit"],
+                    should_stop=token.is_set,
+                )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._scrape_pool, run)
+
+    async def _download(self, payload, token):
+        cached = transcoder.cached(payload["url"], OUTPUT_PATH)
+        if cached:
+            return {"path": cached}
+        r = await downloader.download_with_policy(
+            payload["url"], OUTPUT_PATH, self.limiter, self.breaker,
+            retries=DOWNLOAD_RETRIES, backoff_base=DOWNLOAD_BACKOFF_BASE,
+            cancel_token=token,
+        )
+        if not r:
+            return {"path": None}
+        path = await transcoder.fit(r[0])
+        # a kept source (TRANSCODE_KEEP_SOURCE) is reported so the frontend's cache can track it
+        kept = r[0] if path != r[0] and os.path.exists(r[0]) else None
+        return {"path": path, "source": kept}
+
+
+def run_worker(queue, with_browser=True):
+    """Blocking worker entry point."""
+    driver = driver_lock = None
+    if with_browser:
+        driver, driver_lock, _cookie_jar = start_browser_session()
+    else:
+        load_download_cookies()
+    worker = Worker(queue, driver, driver_lock)
+    try:
+        asyncio.run(worker.run())
+    except KeyboardInterrupt:
+        log(f"👷 worker {worker.id} stopping")
+
+•== END worker.py ==•
+
+•== START profiler.py ==•
+
+# profiler.py
+"""
+Opt-in sampling profiler for single requests. Off by default; a request is
+profiled when its user is in PROFILE_USERS, or when PROFILE_SLOW_PERCENT > 0
+(every request is sampled, but a profile is only written if the request
+ended up in the slowest N%).
+
+A background thread samples sys._current_frames() every PROFILE_INTERVAL:
+the event-loop thread while the request's task is running, plus executor
+threads tagged with the request id (scrape, yt-dlp). Output is one
+collapsed-stack file per request (flamegraph.pl / speedscope format), with
+request, stage and thread as the root frames. The sampler thread only runs
+while a profiled request is in flight, so the disabled cost is one check per
+request and per executor call.
+"""
+
+import asyncio
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from config import (
+    PROFILE_USERS,
+    PROFILE_SLOW_PERCENT,
+    PROFILE_INTERVAL,
+    PROFILE_DIR,
+    PROFILE_MAX_FILES,
+    log,
+    log_context,
+)
+
+MAX_DEPTH = 64
+
+
+class ProfileSession:
+    def __init__(self, request_id, user_id, keep_always):
+        self.request_id = request_id
+        self.user_id = user_id
+        self.keep_always = keep_always
+        self.started = time.monotonic()
+        self.samples = Counter()
+        self.loop = asyncio.get_running_loop()
+        self.loop_ident = threading.get_ident()
+        self.task = asyncio.current_task()
+
+    def add(self, stage, thread, frame):
+        stack = []
+        while frame is not None and len(stack) < MAX_DEPTH:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.reverse()
+        self.samples[";".join([f"request {self.request_id}", f"stage {stage}", f"thread {thread}"] + stack)] += 1
+
+
+class Profiler:
+    def __init__(self):
+        self._sessions = {}        # request_id -> ProfileSession
+        self._thread_tags = {}     # thread ident -> (request_id, stage)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._durations = deque(maxlen=200)
+
+    @property
+    def enabled(self):
+        return bool(PROFILE_USERS) or PROFILE_SLOW_PERCENT > 0
+
+    # ---------------- request lifecycle ----------------
+    def start(self, request_id, user_id):
+        """Call from the request's task. Returns a session or None (not profiled)."""
+        if not self.enabled:
+            return None
+        keep_always = user_id in PROFILE_USERS
+        if not keep_always and PROFILE_SLOW_PERCENT <= 0:
+            return None
+        session = ProfileSession(request_id, user_id, keep_always)
+        with self._lock:
+            self._sessions[request_id] = session
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._thread.start()
+        return session
+
+    def finish(self, session):
+        if session is None:
+            return None
+        with self._lock:
+            self._sessions.pop(session.request_id, None)
+        duration = time.monotonic() - session.started
+        slow = self._is_slow(duration)
+        self._durations.append(duration)
+        if not (session.keep_always or slow) or not session.samples:
+            return None
+        return self._write(session, duration)
+
+    def _is_slow(self, duration):
+        if PROFILE_SLOW_PERCENT <= 0 or len(self._durations) < 20:
+            return False
+        ordered = sorted(self._durations)
+        cutoff = ordered[min(len(ordered) - 1, int(len(ordered) * (1 - PROFILE_SLOW_PERCENT / 100.0)))]
+        return duration >= cutoff
+
+    # ---------------- executor threads ----------------
+    def tagged(self, fn, stage=None):
+        """Wrap a function run in an executor so its thread's samples go to the current request."""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self._sessions:
+                return fn(*args, **kwargs)
+            ctx = log_context.get()
+            rid = ctx.get("request_id")
+            if rid not in self._sessions:
+                return fn(*args, **kwargs)
+            ident = threading.get_ident()
+            self._thread_tags[ident] = (rid, stage or ctx.get("stage") or "executor")
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._thread_tags.pop(ident, None)
+        return wrapper
+
+    # ---------------- sampling ----------------
+    def _sample_loop(self):
+        while True:
+            time.sleep(PROFILE_INTERVAL)
+            with self._lock:
+                if not self._sessions:
+                    self._thread = None
+                    return
+                sessions = dict(self._sessions)
+            frames = sys._current_frames()
+            for ident, (rid, stage) in list(self._thread_tags.items()):
+                session = sessions.get(rid)
+                frame = frames.get(ident)
+                if session and frame is not None:
+                    session.add(stage, "worker", frame)
+            for session in sessions.values():
+                frame = frames.get(session.loop_ident)
+                if frame is not None and self._task_running(session, len(sessions)):
+                    session.add("loop", "loop", frame)
+
+    @staticmethod
+    def _task_running(session, active):
+        try:
+            return asyncio.current_task(session.loop) is session.task
+        except RuntimeError:
+            # can't see the loop's current task from here: only attribute when unambiguous
+            return active == 1
+
+    # ---------------- output ----------------
+    def _write(self, session, duration):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{session.request_id}-{duration:.1f}s.folded"
+        path = os.path.join(PROFILE_DIR, name)
+        with open(path, "w") as f:
+            for stack, count in session.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        log(f"🔬 profile for request {session.request_id} ({duration:.1f}s) -> {path}")
+        self._prune()
+        return path
+
+    def _prune(self):
+        files = latest_profiles(limit=None)
+        for old in files[PROFILE_MAX_FILES:]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+
+def latest_profiles(limit=5):
+    """Profile files, newest first."""
+    try:
+        names = [n for n in os.listdir(PROFILE_DIR) if n.endswith(".folded")]
+    except FileNotFoundError:
+        return []
+    paths = sorted((os.path.join(PROFILE_DIR, n) for n in names), key=os.path.getmtime, reverse=True)
+    return paths if limit is None else paths[:limit]
+
+
+profiler = Profiler()
+
+•== END profiler.py ==•
+
+•== START transcode.py ==•
+
+# transcode.py
+"""
+Optional post-download step: probe each file with ffprobe and, if it is
+over Telegram's upload limit or the bitrate target, remux or re-encode it
+with CPU x264 presets so it fits. ffmpeg runs in a bounded process pool so
+it overlaps with the downloads still in flight instead of blocking the
+batch. Outputs are named <video id>.tg.mp4 next to the download, so a
+video that was already processed is reused instead of transcoded again.
+"""
+
+import asyncio
+import json
+import os
+import re
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from config import (
+    TRANSCODE_ENABLED,
+    TRANSCODE_WORKERS,
+    TRANSCODE_MAX_BYTES,
+    TRANSCODE_MAX_KBPS,
+    TRANSCODE_PRESET,
+    TRANSCODE_AUDIO_KBPS,
+    TRANSCODE_MAX_HEIGHT,
+    TRANSCODE_TIMEOUT,
+    TRANSCODE_KEEP_SOURCE,
+    FFMPEG_BIN,
+    FFPROBE_BIN,
+    log,
+)
+import metrics
+
+TRANSCODES = metrics.counter("transcodes_total", "Post-download processing results by action")
+
+SUFFIX = ".tg.mp4"
+VIDEO_ID = re.compile(r"/video/(\d+)")
+MIN_VIDEO_KBPS = 150       # below this the result isn't worth sending
+COPY_AUDIO = {"aac", "mp3"}
+
+
+def output_path(path):
+    """Cache key: the yt-dlp video id (file stem) plus SUFFIX, next to the source."""
+    stem = os.path.basename(path).split(".", 1)[0]
+    return os.path.join(os.path.dirname(path), stem + SUFFIX)
+
+
+# ---------------- runs inside the process pool ----------------
+def probe(path):
+    out = subprocess.run(
+        [FFPROBE_BIN, "-v", "error", "-print_format", "json", "-show_format", "-show_streams", path],
+        capture_output=True, text=True, timeout=60, check=True,
+    ).stdout
+    data = json.loads(out)
+    fmt = data.get("format", {})
+    video = next((s for s in data.get("streams", []) if s.get("codec_type") == "video"), {})
+    audio = next((s for s in data.get("streams", []) if s.get("codec_type") == "audio"), {})
+    size = int(fmt.get("size") or os.path.getsize(path))
+    duration = float(fmt.get("duration") or 0)
+    kbps = int(fmt.get("bit_rate") or 0) / 1000 or (size * 8 / duration / 1000 if duration else 0)
+    return {
+        "size": size,
+        "duration": duration,
+        "kbps": kbps,
+        "format": fmt.get("format_name", ""),
+        "vcodec": video.get("codec_name"),
+        "acodec": audio.get("codec_name"),
+        "height": int(video.get("height") or 0),
+    }
+
+
+def _ffmpeg(args, dst, timeout):
+    tmp = dst + ".part"
+    try:
+        subprocess.run([FFMPEG_BIN, "-y", "-v", "error", *args, "-movflags", "+faststart", "-f", "mp4", tmp],
+                       capture_output=True, timeout=timeout, check=True)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def process(src, dst, max_bytes, max_kbps, preset, audio_kbps, max_height, timeout):
+    """Returns (path, action). action: keep | remux | encode | too_big."""
+    info = probe(src)
+    fits = info["size"] <= max_bytes and (not max_kbps or info["kbps"] <= max_kbps)
+    playable = "mp4" in info["format"] and info["vcodec"] == "h264" and info["acodec"] in COPY_AUDIO | {None}
+    if fits and playable:
+        return src, "keep"
+    if fits and info["vcodec"] == "h264" and info["acodec"] in COPY_AUDIO | {None}:
+        # right codecs, wrong container: a stream copy is enough
+        _ffmpeg(["-i", src, "-c", "copy"], dst, timeout)
+        return dst, "remux"
+
+    if not info["duration"]:
+        return src, "keep"
+    # fit the size budget (5% container overhead), capped by the bitrate target
+    budget = max_bytes * 8 / info["duration"] / 1000 * 0.95 - audio_kbps
+    video_kbps = min(budget, max_kbps - audio_kbps) if max_kbps else budget
+    if video_kbps < MIN_VIDEO_KBPS:
+        return src, "too_big"
+    scale = []
+    if max_height and info["height"] > max_height:
+        scale = ["-vf", f"scale=-2:{max_height}"]
+    for attempt in range(2):
+        kbps = int(video_kbps * (0.8 if attempt else 1.0))
+        _ffmpeg(["-i", src, *scale, "-c:v", "libx264", "-preset", preset, "-pix_fmt", "yuv420p",
+                 "-b:v", f"{kbps}k", "-maxrate", f"{kbps}k", "-bufsize", f"{kbps * 2}k",
+                 "-c:a", "aac", "-b:a", f"{audio_kbps}k"], dst, timeout)
+        if os.path.getsize(dst) <= max_bytes:
+            return dst, "encode"
+    os.remove(dst)
+    return src, "too_big"
+
+
+# ---------------- event-loop side ----------------
+class Transcoder:
+    def __init__(self, workers=TRANSCODE_WORKERS, enabled=TRANSCODE_ENABLED):
+        self.workers = workers
+        self.enabled = enabled and self._have_ffmpeg()
+        self._pool = None
+        self._inflight = {}   # output path -> future, so one video id is processed once
+
+    @staticmethod
+    def _have_ffmpeg():
+        missing = [b for b in (FFMPEG_BIN, FFPROBE_BIN) if shutil.which(b) is None]
+        if missing:
+            log(f"[WARNING] transcoding disabled, not found: {', '.join(missing)}")
+            return False
+        return True
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def cached(self, url, outdir):
+        """Processed output already on disk for this url's video id, so the download can be skipped."""
+        m = VIDEO_ID.search(url)
+        if not self.enabled or not m:
+            return None
+        path = output_path(os.path.join(outdir, m.group(1)))
+        if not os.path.exists(path):
+            return None
+        TRANSCODES.inc(action="cached")
+        return path
+
+    async def fit(self, path):
+        """Return a path that fits the upload limits (the original if nothing to do or on failure)."""
+        if not self.enabled or path.endswith(SUFFIX):
+            return path
+        dst = output_path(path)
+        if os.path.exists(dst):
+            TRANSCODES.inc(action="cached")
+            self._drop_source(path)
+            return dst
+        fut = self._inflight.get(dst)
+        if fut is None:
+            fut = asyncio.ensure_future(self._run(path, dst))
+            self._inflight[dst] = fut
+            fut.add_done_callback(lambda _f: self._inflight.pop(dst, None))
+        return await asyncio.shield(fut)
+
+    async def _run(self, path, dst):
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.timer("transcode"):
+                out, action = await loop.run_in_executor(
+                    self._executor(), process, path, dst, TRANSCODE_MAX_BYTES, TRANSCODE_MAX_KBPS,
+                    TRANSCODE_PRESET, TRANSCODE_AUDIO_KBPS, TRANSCODE_MAX_HEIGHT, TRANSCODE_TIMEOUT,
+                )
+        except Exception as e:
+            TRANSCODES.inc(action="error")
+            log(f"[WARNING] transcode failed for {os.path.basename(path)}: {e}")
+            return path
+        TRANSCODES.inc(action=action)
+        if action == "too_big":
+            log(f"[WARNING] {os.path.basename(path)} can't fit {TRANSCODE_MAX_BYTES} bytes, sending as-is")
+        elif out != path:
+            log(f"🎞️ {action} {os.path.basename(path)} -> {os.path.basename(out)} ({os.path.getsize(out)} bytes)")
+            self._drop_source(path)
+        return out
+
+    @staticmethod
+    def _drop_source(path):
+        if TRANSCODE_KEEP_SOURCE:
+            return
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+transcoder = Transcoder()
+
+•== END transcode.py ==•
+
+•== START search_fixtures.py ==•
+
+# search_fixtures.py
+"""
+Search payloads in the layouts tiktok.parse_search_payload has to handle,
+trimmed to the fields it reads (plus a few neighbours it must ignore):
+
+  SIGI_STATE           embedded state, ItemModule keyed by id, author as a string
+  SEARCH_API           /api/search/general/full response, data[].item, mixed with a user card
+  UNIVERSAL_DATA       __UNIVERSAL_DATA_FOR_REHYDRATION__ state, items under __DEFAULT_SCOPE__
+
+  python search_fixtures.py    # asserts the parser against all of them
+
+bench.py serves the same layouts (with fresh ids) from its fixture server.
+"""
+
+import copy
+import sys
+
+SIGI_STATE = {
+    "AppContext": {"appContext": {"language": "en", "region": "US"}},
+    "ItemModule": {
+        "7301234567890123456": {
+            "id": "7301234567890123456",
+            "desc": "when the prank goes wrong #funny",
+            "createTime": "1699999999",
+            "video": {"id": "7301234567890123456", "height": 1024, "width": 576, "duration": 15},
+            "author": "prankster",
+            "music": {"id": "7009876543210987654", "title": "original sound"},
+            "stats": {"diggCount": 1200, "shareCount": 31, "commentCount": 44, "playCount": 45000},
+        },
+        "7301234567890123457": {
+            "id": "7301234567890123457",
+            "desc": "part 2",
+            "createTime": "1700000500",
+            "video": {"id": "7301234567890123457", "height": 1024, "width": 576, "duration": 42},
+            "author": "prankster",
+            "stats": {"diggCount": 90000, "shareCount": 800, "commentCount": 1200, "playCount": 2100000},
+        },
+    },
+    "ItemList": {"search": {"list": ["7301234567890123456", "7301234567890123457"], "hasMore": True}},
+    "UserModule": {"users": {"prankster": {"id": "6812345678901234567", "uniqueId": "prankster"}}},
+}
+
+SEARCH_API = {
+    "status_code": 0,
+    "data": [
+        {
+            "type": 4,
+            "user_list": [{"user_info": {"uid": "6899999999999999999", "unique_id": "funnycat", "follower_count": 10}}],
+        },
+        {
+            "type": 1,
+            "item": {
+                "id": "7312345678901234567",
+                "desc": "cat vs cucumber",
+                "createTime": 1701000000,
+                "video": {"id": "7312345678901234567", "duration": 9, "ratio": "720p"},
+                "author": {"id": "6855555555555555555", "uniqueId": "funnycat", "nickname": "Funny Cat"},
+                "stats": {"diggCount": 500, "shareCount": 2, "commentCount": 7, "playCount": 8000},
+                "statsV2": {"diggCount": "500", "playCount": "8000"},
+            },
+        },
+        {
+            "type": 1,
+            "item": {
+                "id": "7312345678901234568",
+                "desc": "cat vs cucumber 2",
+                "createTime": 1701000100,
+                "video": {"id": "7312345678901234568", "duration": 11, "ratio": "720p"},
+                "author": {"id": "6855555555555555555", "uniqueId": "funnycat", "nickname": "Funny Cat"},
+                "stats": {"diggCount": 70000, "shareCount": 90, "commentCount": 300, "playCount": 990000},
+            },
+        },
+    ],
+    "has_more": 1,
+    "cursor": 12,
+    "log_pb": {"impr_id": "20231126000000000000000000000000"},
+}
+
+UNIVERSAL_DATA = {
+    "__DEFAULT_SCOPE__": {
+        "webapp.app-context": {"language": "en", "user": {}},
+        "webapp.search": {
+            "item_list": [
+                {
+                    "id": "7323456789012345678",
+                    "desc": "skate fail",
+                    "createTime": 1702000000,
+                    "video": {"duration": 20},
+                    "author": {"uniqueId": "skater", "id": "6866666666666666666"},
+                    "stats": {"diggCount": 3, "playCount": 120},
+                },
+            ],
+        },
+    },
+}
+
+# script id the embedded layouts ship under (see tiktok.STATE_SCRIPT_IDS)
+STATE_SCRIPTS = {"sigi": ("SIGI_STATE", SIGI_STATE), "universal": ("__UNIVERSAL_DATA_FOR_REHYDRATION__", UNIVERSAL_DATA)}
+
+
+def fresh_payload(layout, ids, views):
+    """Copy of a layout ("sigi" | "api" | "universal") holding one item per id, cloned from its first item."""
+    if layout == "sigi":
+        payload = copy.deepcopy(SIGI_STATE)
+        template = next(iter(payload["ItemModule"].values()))
+        payload["ItemModule"] = {}
+        for vid, v in zip(ids, views):
+            item = copy.deepcopy(template)
+            item["id"] = item["video"]["id"] = vid
+            item["stats"]["playCount"] = v
+            payload["ItemModule"][vid] = item
+        payload["ItemList"]["search"]["list"] = list(ids)
+        return payload
+    if layout == "api":
+        payload = copy.deepcopy(SEARCH_API)
+        template = next(d for d in payload["data"] if "item" in d)
+        payload["data"] = [d for d in payload["data"] if "item" not in d]
+        for vid, v in zip(ids, views):
+            entry = copy.deepcopy(template)
+            entry["item"]["id"] = entry["item"]["video"]["id"] = vid
+            entry["item"]["stats"]["playCount"] = v
+            payload["data"].append(entry)
+        return payload
+    payload = copy.deepcopy(UNIVERSAL_DATA)
+    items = payload["__DEFAULT_SCOPE__"]["webapp.search"]["item_list"]
+    template = items[0]
+    items[:] = []
+    for vid, v in zip(ids, views):
+        item = copy.deepcopy(template)
+        item["id"] = vid
+        item["stats"]["playCount"] = v
+        items.append(item)
+    return payload
+
+
+def author_of(layout):
+    return {"sigi": "prankster", "api": "funnycat", "universal": "skater"}[layout]
+
+
+# ---------------- checks ----------------
+def check():
+    from tiktok import parse_search_payload, rank_search_results
+
+    r = parse_search_payload(SIGI_STATE)
+    assert {x["id"] for x in r} == {"7301234567890123456", "7301234567890123457"}, r
+    first = rank_search_results(r)[0]
+    assert first["url"] == "https://www.tiktok.com/@prankster/video/7301234567890123457", first
+    assert (first["views"], first["likes"], first["duration"]) == (2100000, 90000, 42), first
+
+    r = parse_search_payload(SEARCH_API)
+    assert [x["id"] for x in r] == ["7312345678901234567", "7312345678901234568"], r   # user card skipped
+    assert all(x["author"] == "funnycat" for x in r), r
+    assert rank_search_results(r)[0]["views"] == 990000, r
+
+    r = parse_search_payload(UNIVERSAL_DATA)
+    assert [x["url"] for x in r] == ["https://www.tiktok.com/@skater/video/7323456789012345678"], r
+
+    # no search results in the state -> nothing, not the author/user objects
+    assert parse_search_payload({"UserModule": SIGI_STATE["UserModule"], "AppContext": {}}) == []
+    assert parse_search_payload({"data": SEARCH_API["data"][:1]}) == []
+
+    # the bench's generated pages parse the same way
+    for layout in ("sigi", "api", "universal"):
+        ids = [str(7399999999999999000 + i) for i in range(3)]
+        r = parse_search_payload(fresh_payload(layout, ids, [5, 50, 500]))
+        assert [x["id"] for x in rank_search_results(r)] == ids[::-1], (layout, r)
+        assert all(x["author"] == author_of(layout) for x in r), (layout, r)
+    return True
+
+
+if __name__ == "__main__":
+    check()
+    print("search fixtures: ok")
+    sys.exit(0)
+
+•== END search_fixtures.py ==•